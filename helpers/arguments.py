@@ -468,7 +468,7 @@ def parse_args(input_args=None):
         action="store_true",
         default=False,
         help=(
-            "If set, will gzip-compress the disk cache for Pytorch files. This will save substantial disk space, but may slow down the training process."
+            "If set, will compress the disk cache for Pytorch files, using zstd if the zstandard package is installed and gzip otherwise. This will save substantial disk space, but may slow down the training process."
         ),
     )
     parser.add_argument(
@@ -1372,8 +1372,38 @@ def parse_args(input_args=None):
         help=(
             "When training a LoRA, you might want to quantise the base model to a lower precision to save more VRAM."
             " The default value, 'no_change', does not quantise any weights."
+            " Using 'bf16' only casts the weights to bfloat16, which halves fp32 memory without any dequantisation overhead."
             " Using 'fp4-bnb' or 'fp8-bnb' will require Bits n Bytes for quantisation (NVIDIA, maybe AMD)."
-            " Using 'fp8-quanto' will require Quanto for quantisation (Apple Silicon, NVIDIA, AMD)."
+            " The 'int8-quanto', 'int4-quanto' and 'int2-quanto' levels are quantised by SimpleTuner itself and don't need Quanto;"
+            " their names are kept for compatibility with existing configurations."
+            " Using 'fp8-quanto' runs natively on Ada and Hopper GPUs, and requires Quanto for quantisation on other NVIDIA and AMD GPUs."
+        ),
+    )
+    parser.add_argument(
+        "--fp8_activation_warmup_steps",
+        type=int,
+        default=0,
+        help=(
+            "When using fp8-quanto on a Hopper GPU, the transformer's fp8 layers can average their activation scale"
+            " over this many forward passes, and reuse that static scale afterward instead of measuring it on every call."
+            " The default value, 0, keeps measuring it on every call."
+        ),
+    )
+    parser.add_argument(
+        "--disable_quantisation_cache",
+        action="store_true",
+        help=(
+            "Quantised weights are normally kept on disk and reused by later runs of the same checkpoint and precision."
+            " This option always quantises the models again, and doesn't write the results to disk."
+        ),
+    )
+    parser.add_argument(
+        "--int8_activation_quantisation",
+        action="store_true",
+        help=(
+            "By default, int8-quanto only quantises the weights, and multiplies them with the activations in their original precision."
+            " This option also quantises the activations to int8 and multiplies them with torch._int_mm where the batch is large enough,"
+            " which is faster on GPUs with int8 tensor cores, but changes the numerics and the gradients reaching the LoRA adapters."
         ),
     )
     for i in range(1, 4):
@@ -1385,8 +1415,10 @@ def parse_args(input_args=None):
             help=(
                 f"When training a LoRA, you might want to quantise text encoder {i} to a lower precision to save more VRAM."
                 " The default value is to follow base_model_precision (no_change)."
+                " Using 'bf16' only casts the weights to bfloat16, which halves fp32 memory without any dequantisation overhead."
                 " Using 'fp4-bnb' or 'fp8-bnb' will require Bits n Bytes for quantisation (NVIDIA, maybe AMD)."
-                " Using 'fp8-quanto' will require Quanto for quantisation (Apple Silicon, NVIDIA, AMD)."
+                " The 'int8-quanto', 'int4-quanto' and 'int2-quanto' levels are quantised by SimpleTuner itself and don't need Quanto."
+                " Using 'fp8-quanto' runs natively on Ada and Hopper GPUs, and requires Quanto for quantisation on other NVIDIA and AMD GPUs."
             ),
         )
     parser.add_argument(
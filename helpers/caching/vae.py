@@ -9,6 +9,7 @@ from pathlib import Path
 from PIL import Image
 from numpy import str_ as numpy_str
 from helpers.multiaspect.image import MultiaspectImage
+from helpers.image_manipulation.batched_resize import BatchedResizer
 from helpers.image_manipulation.training_sample import TrainingSample, PreparedSample
 from helpers.data_backend.base import BaseDataBackend
 from helpers.metadata.backends.base import MetadataBackend
@@ -23,9 +24,9 @@ logger = logging.getLogger("VAECache")
 logger.setLevel(os.environ.get("SIMPLETUNER_LOG_LEVEL", "INFO"))
 
 
-def prepare_sample(
+def load_training_sample(
     image: Image.Image = None, data_backend_id: str = None, filepath: str = None
-):
+) -> TrainingSample:
     metadata = StateTracker.get_metadata_by_filepath(
         filepath, data_backend_id=data_backend_id
     )
@@ -34,12 +35,22 @@ def prepare_sample(
     image_data = image
     if image_data is None:
         image_data = data_sampler.yield_single_image(filepath)
-    training_sample = TrainingSample(
+    return TrainingSample(
         image=image_data,
         data_backend_id=data_backend_id,
         image_metadata=metadata,
         image_path=filepath,
     )
+
+
+def prepare_sample(
+    image: Image.Image = None,
+    data_backend_id: str = None,
+    filepath: str = None,
+    training_sample: TrainingSample = None,
+):
+    if training_sample is None:
+        training_sample = load_training_sample(image, data_backend_id, filepath)
     prepared_sample = training_sample.prepare()
     return (
         prepared_sample.image,
@@ -72,6 +83,7 @@ class VAECache:
         max_workers: int = 32,
         vae_cache_ondemand: bool = False,
         hash_filenames: bool = False,
+        resize_backend: str = "pil",
     ):
         self.id = id
         if image_data_backend.id != id:
@@ -101,13 +113,17 @@ class VAECache:
         self.process_queue_size = process_queue_size
         self.vae_batch_size = vae_batch_size
         self.instance_data_dir = instance_data_dir
-        self.transform = MultiaspectImage.get_image_transforms()
         self.rank_info = rank_info()
         self.metadata_backend = metadata_backend
         if not self.metadata_backend.image_metadata_loaded:
             self.metadata_backend.load_image_metadata()
 
         self.vae_cache_ondemand = vae_cache_ondemand
+        # With batched_torch, each batch's intermediary resizes run as grouped tensor resizes
+        # on the accelerator, rather than one PIL resize per image in prepare().
+        self.batched_resizer = None
+        if resize_backend == "batched_torch":
+            self.batched_resizer = BatchedResizer(device=accelerator.device)
 
         self.max_workers = max_workers
         if (maximum_image_size and not target_downsample_size) or (
@@ -613,13 +629,22 @@ class VAECache:
             # Process Pool Execution
             processed_images = []
             with ThreadPoolExecutor(self.max_workers) as executor:
+                training_samples = [None] * len(initial_data)
+                if self.batched_resizer is not None:
+                    training_samples = list(
+                        executor.map(self._load_training_sample, initial_data)
+                    )
+                    self.batched_resizer.resize_samples(
+                        [sample for sample in training_samples if sample is not None]
+                    )
                 futures = [
                     executor.submit(
                         prepare_sample,
                         data_backend_id=self.id,
                         filepath=data[0],
+                        training_sample=training_sample,
                     )
-                    for data in initial_data
+                    for data, training_sample in zip(initial_data, training_samples)
                 ]
                 first_aspect_ratio = None
                 for future in futures:
@@ -672,8 +697,8 @@ class VAECache:
                 filepath, _, aspect_bucket = initial_data[idx]
                 filepaths.append(filepath)
 
-                pixel_values = self.transform(image).to(
-                    self.accelerator.device, dtype=self.vae.dtype
+                pixel_values = MultiaspectImage.image_to_tensor(
+                    image, device=self.accelerator.device, dtype=self.vae.dtype
                 )
                 output_value = (pixel_values, filepath, aspect_bucket, is_final_sample)
                 output_values.append(output_value)
@@ -708,6 +733,14 @@ class VAECache:
             raise e
         return output_values
 
+    def _load_training_sample(self, data: tuple):
+        try:
+            return load_training_sample(data_backend_id=self.id, filepath=data[0])
+        except Exception as e:
+            # Left to prepare_sample, which reports the failure in the usual way.
+            self.debug_log(f"Could not load {data[0]} for batched resizing: {e}")
+            return None
+
     def _encode_images_in_batch(
         self, image_pixel_values: list = None, disable_queue: bool = False
     ) -> None:
@@ -3,6 +3,13 @@ from io import BytesIO
 import gzip
 import torch
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
 
 class BaseDataBackend(ABC):
     @abstractmethod
@@ -91,9 +98,20 @@ class BaseDataBackend(ABC):
 
     def _decompress_torch(self, gzip_data):
         """
-        We've read the gzip from disk. Just decompress it.
+        We've read the compressed data from disk. Just decompress it.
+
+        Older caches were written with gzip, so the format is detected from the header.
         """
         gzip_data.seek(0)
+        if gzip_data.read(4) == ZSTD_MAGIC:
+            if zstandard is None:
+                raise ImportError(
+                    "This cache was compressed with zstd. Please install the zstandard package to read it."
+                )
+            gzip_data.seek(0)
+            with zstandard.ZstdDecompressor().stream_reader(gzip_data) as reader:
+                return BytesIO(reader.read())
+        gzip_data.seek(0)
         with gzip.GzipFile(fileobj=gzip_data, mode="rb") as file:
             decompressed_data = file.read()
         return BytesIO(decompressed_data)
@@ -101,11 +119,18 @@ class BaseDataBackend(ABC):
     def _compress_torch(self, data):
         """
         Compress the torch data before writing it to disk.
+
+        zstd is used when available, as it is several times faster than gzip at a similar ratio.
         """
         output_data_container = BytesIO()
         torch.save(data, output_data_container)
-        output_data_container.seek(0)
 
+        if zstandard is not None:
+            return zstandard.ZstdCompressor(level=3).compress(
+                output_data_container.getbuffer()
+            )
+
+        output_data_container.seek(0)
         with BytesIO() as compressed_output:
             with gzip.GzipFile(fileobj=compressed_output, mode="wb") as file:
                 file.write(output_data_container.getvalue())
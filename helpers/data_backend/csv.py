@@ -1,11 +1,18 @@
+import concurrent.futures
+from collections import defaultdict
 import fnmatch
+import functools
 import io
+import itertools
 from datetime import datetime
 from urllib.request import url2pathname
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
 import requests
 from PIL import Image
+from requests.adapters import HTTPAdapter
 
 from helpers.data_backend.base import BaseDataBackend
 from helpers.image_manipulation.load import load_image
@@ -14,6 +21,9 @@ from pathlib import Path
 from io import BytesIO
 import os
 import logging
+import shutil
+import threading
+import time
 import torch
 from typing import Any, Union, Optional, BinaryIO
 
@@ -23,11 +33,20 @@ if should_log():
 else:
     logger.setLevel("ERROR")
 
+# URLs larger than one chunk are downloaded as several range requests in parallel.
+DOWNLOAD_CHUNK_SIZE = 8 * 1024**2
+DOWNLOAD_THREADS = 4
+# A partial download that hasn't been written to for this many seconds is considered abandoned.
+DOWNLOAD_STALE_TIMEOUT = 60
+# Metadata files that may be listed in the csv, but are never images.
+NON_IMAGE_EXTENSIONS = frozenset([".json", ".csv", ".parquet"])
+
 
 def url_to_filename(url: str) -> str:
     return url.split("/")[-1]
 
 
+@functools.lru_cache(maxsize=1 << 16)
 def shorten_and_clean_filename(filename: str, no_op: bool):
     if no_op:
         return filename
@@ -37,6 +56,7 @@ def shorten_and_clean_filename(filename: str, no_op: bool):
     return filename
 
 
+@functools.lru_cache(maxsize=1 << 16)
 def html_to_file_loc(parent_directory: Path, url: str, shorten_filenames: bool) -> str:
     filename = url_to_filename(url)
     cached_loc = str(
@@ -59,44 +79,119 @@ class CSVDataBackend(BaseDataBackend):
         url_column: str = "url",
         image_cache_loc: Optional[str] = None,
         shorten_filenames: bool = False,
+        max_workers: int = 32,
     ):
         self.id = id
         self.type = "csv"
         self.compress_cache = compress_cache
         self.shorten_filenames = shorten_filenames
+        self.max_workers = max_workers
+        # One pooled session per backend, sized so every batch worker can keep its connection alive.
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=max_workers, pool_maxsize=max_workers, max_retries=3
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._url_locks = {}
+        self._url_locks_guard = threading.Lock()
         self.csv_file = csv_file
         self.accelerator = accelerator
         self.image_url_col = image_url_col
-        self.df = pd.read_csv(csv_file, index_col=image_url_col)
-        self.df = self.df.groupby(level=0).last()  # deduplicate by index (image loc)
+        # save_state writes the frame next to the csv as parquet, which is much faster to write
+        # and read back. It is only used while it's newer than the csv it came from, and has its
+        # own suffix so that a dataset's data.parquet beside data.csv is never mistaken for it.
+        self.state_file = Path(f"{csv_file}.state.parquet")
+        if (
+            self.state_file.exists()
+            and self.state_file.stat().st_mtime >= Path(csv_file).stat().st_mtime
+        ):
+            logger.info(f"Loading CSV dataset state from {self.state_file}")
+            self.df = pd.read_parquet(
+                self.state_file, engine="pyarrow", dtype_backend="pyarrow"
+            ).set_index(image_url_col)
+        else:
+            # pyarrow parses the csv on multiple threads and keeps the url and caption
+            # strings in arrow-backed columns, rather than python objects. Captions are
+            # frequently repeated across rows, so they're stored once each as categories.
+            self.df = pd.read_csv(
+                csv_file,
+                engine="pyarrow",
+                dtype_backend="pyarrow",
+                dtype=(
+                    {caption_column: "category"} if caption_column is not None else None
+                ),
+            )
+            # deduplicate by image loc, keeping the last entry, before indexing on it.
+            self.df = self.df.drop_duplicates(
+                subset=image_url_col, keep="last"
+            ).set_index(image_url_col)
         self.caption_column = caption_column
+        # Captions are looked up once per sample, per epoch; a plain dict is far cheaper than df.loc.
+        self._caption_map = {}
+        if caption_column is not None and caption_column in self.df.columns:
+            self._caption_map = dict(
+                zip(self.df.index.tolist(), self.df[caption_column].tolist())
+            )
+        # Membership checks go through a plain set mirroring the index. Rows written by torch_save
+        # or removed by delete are applied to the frame in bulk by _flush_pending_index.
+        self._index_set = set(self.df.index.tolist())
+        self._pending_index = set()
+        self._pending_deletes = set()
+        self._update_url_mask()
         self.url_column = url_column
         self.image_cache_loc = (
             Path(image_cache_loc) if image_cache_loc is not None else None
         )
+        # Names already in the image cache, listed once so cache hits don't each need a stat().
+        self._cached_files = set()
+        if self.image_cache_loc is not None and self.image_cache_loc.is_dir():
+            with os.scandir(self.image_cache_loc) as entries:
+                self._cached_files = {entry.name for entry in entries}
+        self._cached_locs = self._get_cached_locs()
 
-    def read(self, location, as_byteIO: bool = False):
-        """Read and return the content of the file."""
+    def read(self, location, as_byteIO: bool = False, prefetch_only: bool = False):
+        """
+        Read and return the content of the file.
+
+        With prefetch_only, URLs are downloaded into the image cache and the local path is
+        returned, without loading the content into memory.
+        """
         if isinstance(location, Path):
             location = str(location.resolve())
+        if (
+            prefetch_only
+            and location.startswith("http")
+            and self.image_cache_loc is None
+        ):
+            raise ValueError("Cannot prefetch URLs without an image cache location.")
         if location.startswith("http"):
             if self.image_cache_loc is not None:
                 # check for cache
-                cached_loc = html_to_file_loc(
-                    self.image_cache_loc,
-                    location,
-                    shorten_filenames=self.shorten_filenames,
-                )
-                if os.path.exists(cached_loc):
-                    # found cache
-                    location = cached_loc
-                else:
-                    # actually go to website
-                    data = requests.get(location, stream=True).raw.data
-                    with open(cached_loc, "wb") as f:
-                        f.write(data)
+                cached_loc = self._cached_locs.get(location)
+                if cached_loc is None:
+                    cached_loc = html_to_file_loc(
+                        self.image_cache_loc,
+                        location,
+                        shorten_filenames=self.shorten_filenames,
+                    )
+                cached_name = os.path.basename(cached_loc)
+                if cached_name not in self._cached_files:
+                    # Only one worker downloads a given URL; the rest wait for it to land.
+                    with self._url_lock(location):
+                        # Another process sharing the cache may have fetched it since we listed it.
+                        if not os.path.exists(cached_loc):
+                            # actually go to website, streaming straight into the cache.
+                            self._fetch_url(location, cache_path=cached_loc)
+                    self._cached_files.add(cached_name)
+                    with self._url_locks_guard:
+                        # The file is in place, so later readers no longer need the lock.
+                        self._url_locks.pop(location, None)
+                location = cached_loc
             else:
-                data = requests.get(location, stream=True).raw.data
+                data = self._fetch_url(location)
+        if prefetch_only:
+            return location
         if not location.startswith("http"):
             # read from local file
             with open(location, "rb") as file:
@@ -105,6 +200,140 @@ class CSVDataBackend(BaseDataBackend):
             return data
         return BytesIO(data)
 
+    def prefetch_batch(self, locations: list) -> list:
+        """
+        Download a batch of URLs into the image cache concurrently, so that later reads are
+        served from local disk.
+
+        Returns the local path of each location, or None where it could not be fetched.
+        """
+
+        def prefetch(location):
+            try:
+                return self.read(location, prefetch_only=True)
+            except Exception as e:
+                logger.warning(f"Could not prefetch {location}: {e}")
+                return None
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.max_workers
+        ) as executor:
+            return list(executor.map(prefetch, locations))
+
+    def _url_lock(self, url: str) -> threading.Lock:
+        """Return the lock guarding the download of a URL into the image cache."""
+        with self._url_locks_guard:
+            return self._url_locks.setdefault(url, threading.Lock())
+
+    def _fetch_url(self, url: str, cache_path: Optional[str] = None):
+        """
+        Download a URL.
+
+        If cache_path is given, the response body is streamed directly into that file
+        and nothing is returned. Otherwise, the body is returned as bytes.
+        """
+        if cache_path is None:
+            response = self.session.get(url, timeout=30)
+            response.raise_for_status()
+            return response.content
+        # Download into a temp file and move it into place once complete, so that other readers
+        # never see a partially written cache entry. Creating it exclusively also claims the
+        # download, so other processes sharing the cache wait for us rather than repeat it.
+        temp_path = f"{cache_path}.tmp"
+        try:
+            temp_fd = os.open(temp_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return self._wait_for_download(url, cache_path, temp_path)
+        downloaded = False
+        try:
+            with os.fdopen(temp_fd, "wb") as f:
+                # Ask for the first chunk only. Servers without range support send the whole body,
+                # which is streamed as-is; otherwise the remainder is fetched in parallel below.
+                with self.session.get(
+                    url,
+                    stream=True,
+                    timeout=30,
+                    headers={
+                        "Range": f"bytes=0-{DOWNLOAD_CHUNK_SIZE - 1}",
+                        "Accept-Encoding": "identity",
+                    },
+                ) as response:
+                    response.raise_for_status()
+                    # Let urllib3 undo any content-encoding, which .raw does not do by default.
+                    response.raw.decode_content = True
+                    shutil.copyfileobj(response.raw, f, length=1 << 20)
+                    total_size = None
+                    if response.status_code == 206:
+                        # Content-Range: bytes 0-8388607/20971520, where the size may be "*".
+                        content_range = response.headers.get("Content-Range", "")
+                        if content_range.rsplit("/", 1)[-1].isdigit():
+                            total_size = int(content_range.rsplit("/", 1)[-1])
+                if total_size is not None and total_size > DOWNLOAD_CHUNK_SIZE:
+                    f.flush()
+                    self._fetch_url_ranges(url, f.fileno(), total_size)
+            os.replace(temp_path, cache_path)
+            downloaded = True
+        finally:
+            # Also on KeyboardInterrupt, so that no other process waits on an abandoned file.
+            if not downloaded and os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def _wait_for_download(self, url: str, cache_path: str, temp_path: str):
+        """
+        Wait for another process to finish downloading a URL into the cache.
+
+        If that download fails or stalls, we take over and fetch it ourselves.
+        """
+        while not os.path.exists(cache_path):
+            try:
+                idle_time = time.time() - os.stat(temp_path).st_mtime
+            except FileNotFoundError:
+                if os.path.exists(cache_path):
+                    return
+                # The other download gave up; try it ourselves.
+                return self._fetch_url(url, cache_path=cache_path)
+            if idle_time > DOWNLOAD_STALE_TIMEOUT:
+                logger.warning(f"Removing stalled partial download: {temp_path}")
+                try:
+                    os.remove(temp_path)
+                except FileNotFoundError:
+                    pass
+                continue
+            time.sleep(0.1)
+
+    def _fetch_url_ranges(self, url: str, fd: int, total_size: int):
+        """
+        Download everything after the first chunk of a URL in parallel range requests,
+        writing each range into the file descriptor at its own offset.
+        """
+
+        def fetch_range(start: int):
+            end = min(start + DOWNLOAD_CHUNK_SIZE, total_size) - 1
+            response = self.session.get(
+                url,
+                timeout=30,
+                headers={
+                    "Range": f"bytes={start}-{end}",
+                    "Accept-Encoding": "identity",
+                },
+            )
+            response.raise_for_status()
+            if response.status_code != 206 or len(response.content) != end - start + 1:
+                raise ValueError(
+                    f"Received an unexpected response for bytes {start}-{end} of {url}."
+                )
+            os.pwrite(fd, response.content, start)
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=DOWNLOAD_THREADS
+        ) as executor:
+            list(
+                executor.map(
+                    fetch_range,
+                    range(DOWNLOAD_CHUNK_SIZE, total_size, DOWNLOAD_CHUNK_SIZE),
+                )
+            )
+
     def write(self, filepath: Union[str, Path], data: Any) -> None:
         """Write the provided data to the specified filepath."""
         if isinstance(filepath, str):
@@ -134,21 +363,28 @@ class CSVDataBackend(BaseDataBackend):
 
     def delete(self, filepath):
         """Delete the specified file."""
-        if filepath in self.df.index:
-            self.df.drop(filepath, inplace=True)
+        self._pending_index.discard(str(filepath))
+        if filepath in self._index_set:
+            self._index_set.discard(filepath)
+            self._pending_deletes.add(filepath)
+            self._caption_map.pop(filepath, None)
             # self.save_state()
         if os.path.exists(filepath):
             logger.debug(f"Deleting file: {filepath}")
             os.remove(filepath)
+            if self.image_cache_loc is not None and os.path.dirname(filepath) == str(
+                self.image_cache_loc
+            ):
+                self._cached_files.discard(os.path.basename(filepath))
         # Validate that we deleted it correctly.
-        if self.exists(filepath) or filepath in self.df.index:
+        if self.exists(filepath):
             raise Exception(f"Failed to delete {filepath}")
 
     def exists(self, filepath):
         """Check if the file exists."""
         if isinstance(filepath, Path):
             filepath = str(filepath.resolve())
-        return filepath in self.df.index or os.path.exists(filepath)
+        return filepath in self._index_set or os.path.exists(filepath)
 
     def open_file(self, filepath, mode):
         """Open the file in the specified mode."""
@@ -163,29 +399,35 @@ class CSVDataBackend(BaseDataBackend):
         logger.debug(
             f"CSVDataBackend.list_files: str_pattern={str_pattern}, instance_data_dir={instance_data_dir}"
         )
+        self._flush_pending_index()
         if instance_data_dir is None:
             filtered_paths = set(self.df.index)
             filtered_ids = set(filtered_paths)
         else:
-            filtered_ids = set(
-                filter(lambda id: fnmatch.fnmatch(id, str_pattern), list(self.df.index))
-            )
-            filtered_paths = set(
-                filter(lambda id: "http" not in id and os.path.exists(id), filtered_ids)
-            )
+            # Match the whole index at once; fnmatch's trailing \Z is dropped, as it is
+            # not understood by the pyarrow regex engine and fullmatch anchors it anyway.
+            index = self.df.index
+            pattern = fnmatch.translate(str_pattern).removesuffix("\\Z")
+            try:
+                matched = index.str.fullmatch(pattern, na=False)
+            except pa.ArrowInvalid:
+                # RE2 has no atomic groups, which fnmatch emits for patterns with more
+                # than one "*" since Python 3.11, so those are matched with Python's re.
+                matched = index.astype(object).str.fullmatch(pattern, na=False)
+            matched = np.asarray(matched, dtype=bool)
+            filtered_ids = set(index[matched])
+            # Only local paths need to touch the filesystem.
+            local_ids = index[matched & ~self._url_mask]
+            filtered_paths = set(filter(os.path.exists, local_ids))
         # Group files by their parent directory
-        path_dict = {}
+        path_dict = defaultdict(list)
         for path in filtered_paths:
             if hasattr(path, "parent"):
-                parent = str(path.parent)
-                if parent not in path_dict:
-                    path_dict[parent] = []
-                path_dict[parent].append(str(path.absolute()))
+                path_dict[str(path.parent)].append(str(path.absolute()))
             else:
-                if "/" not in path_dict:
-                    path_dict["/"] = []
-                if os.path.splitext(str(path))[1] not in [".json", ".csv", ".parquet"]:
-                    path_dict["/"].append(str(path))
+                files = path_dict["/"]
+                if os.path.splitext(str(path))[1] not in NON_IMAGE_EXTENSIONS:
+                    files.append(str(path))
 
         results = [(subdir, [], files) for subdir, files in path_dict.items()]
         results += [("", [], filtered_ids - filtered_paths)]
@@ -218,32 +460,56 @@ class CSVDataBackend(BaseDataBackend):
         self, filepaths: list, delete_problematic_images: bool = False
     ) -> list:
         """Read a batch of images from the specified filepaths."""
-        if type(filepaths) != list:
+        if isinstance(filepaths, (str, bytes, Path)) or not hasattr(
+            filepaths, "__iter__"
+        ):
             raise ValueError(
-                f"read_image_batch must be given a list of image filepaths. we received: {filepaths}"
+                f"read_image_batch must be given a sequence of image filepaths. we received: {filepaths}"
+            )
+        if not isinstance(filepaths, (list, tuple)):
+            # We iterate over these twice, so one-shot iterables must be materialised.
+            filepaths = list(filepaths)
+        # Most of the time in here is spent waiting on HTTP or disk, so we fan out.
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.max_workers
+        ) as executor:
+            images = list(
+                executor.map(
+                    self._read_image_for_batch,
+                    filepaths,
+                    itertools.repeat(delete_problematic_images),
+                )
             )
         output_images = []
         available_keys = []
-        for filepath in filepaths:
-            try:
-                image_data = self.read_image(filepath, delete_problematic_images)
-                if image_data is None:
-                    logger.warning(f"Unable to load image '{filepath}', skipping.")
-                    continue
-                output_images.append(image_data)
-                available_keys.append(filepath)
-            except Exception as e:
-                if delete_problematic_images:
-                    logger.error(
-                        f"Deleting image '{filepath}', because --delete_problematic_images is provided. Error: {e}"
-                    )
-                else:
-                    logger.warning(
-                        f"A problematic image {filepath} is detected, but we are not allowed to remove it, because --delete_problematic_image is not provided."
-                        f" Please correct this manually. Error: {e}"
-                    )
+        for filepath, image_data in zip(filepaths, images):
+            if image_data is None:
+                continue
+            output_images.append(image_data)
+            available_keys.append(filepath)
         return (available_keys, output_images)
 
+    def _read_image_for_batch(
+        self, filepath: str, delete_problematic_images: bool = False
+    ):
+        """Read a single image for read_image_batch, returning None on failure."""
+        try:
+            image_data = self.read_image(filepath, delete_problematic_images)
+            if image_data is None:
+                logger.warning(f"Unable to load image '{filepath}', skipping.")
+            return image_data
+        except Exception as e:
+            if delete_problematic_images:
+                logger.error(
+                    f"Deleting image '{filepath}', because --delete_problematic_images is provided. Error: {e}"
+                )
+            else:
+                logger.warning(
+                    f"A problematic image {filepath} is detected, but we are not allowed to remove it, because --delete_problematic_image is not provided."
+                    f" Please correct this manually. Error: {e}"
+                )
+            return None
+
     def create_directory(self, directory_path):
         if os.path.exists(directory_path):
             return
@@ -280,8 +546,9 @@ class CSVDataBackend(BaseDataBackend):
         Save a torch tensor to a file.
         """
         if isinstance(location, str) or isinstance(location, Path):
-            if location not in self.df.index:
-                self.df.loc[location] = pd.Series()
+            # Growing the frame one row at a time rebuilds the index on every write.
+            self._index_set.add(str(location))
+            self._pending_index.add(str(location))
             location = self.open_file(location, "wb")
 
         if self.compress_cache:
@@ -292,14 +559,73 @@ class CSVDataBackend(BaseDataBackend):
         location.close()
 
     def write_batch(self, filepaths: list, data_list: list) -> None:
-        """Write a batch of data to the specified filepaths."""
-        for filepath, data in zip(filepaths, data_list):
-            self.write(filepath, data)
+        """Write a batch of data to the specified filepaths concurrently."""
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.max_workers
+        ) as executor:
+            # Consume the results so that a failed write is raised here.
+            list(executor.map(self.write, filepaths, data_list))
 
-    def save_state(self):
-        self.df.to_csv(self.csv_file, index_label=self.image_url_col)
+    def _flush_pending_index(self):
+        """Apply any rows deleted or written since the last flush to the frame."""
+        # Swap the sets out first, so concurrent writers never add to one we're about to drop.
+        deletes, self._pending_deletes = self._pending_deletes, set()
+        pending, self._pending_index = self._pending_index, set()
+        if not deletes and not pending:
+            return
+        if deletes:
+            self.df = self.df.drop(list(deletes), errors="ignore")
+        if pending:
+            new_index = pd.Index(list(pending), dtype=self.df.index.dtype).difference(
+                self.df.index
+            )
+            if len(new_index) > 0:
+                self.df = self.df.reindex(self.df.index.append(new_index))
+        self._update_url_mask()
+
+    def _get_cached_locs(self) -> dict:
+        """
+        Map every URL in the frame to its image cache location, using vectorised string
+        operations that mirror html_to_file_loc.
+        """
+        if self.image_cache_loc is None:
+            return {}
+        urls = self.df.index[self._url_mask].to_series()
+        # Equivalent to url_to_filename: keep everything after the last slash.
+        names = urls.str.replace(r"^.*/", "", regex=True)
+        if not self.shorten_filenames:
+            names = names.str.replace("%20", "-", regex=False).str.replace(
+                " ", "-", regex=False
+            )
+            names = names.where(
+                names.str.len() <= 250, names.str[:120] + "---" + names.str[126:]
+            )
+        # URLs ending in a slash have no filename; html_to_file_loc handles those on demand.
+        names = names[names.str.len() > 0]
+        return dict(
+            zip(
+                names.index.tolist(),
+                (str(self.image_cache_loc) + os.sep + names).tolist(),
+            )
+        )
+
+    def _update_url_mask(self):
+        """Recompute which rows of the index are URLs, in one pass over the index."""
+        self._url_mask = np.asarray(
+            self.df.index.str.startswith("http", na=False), dtype=bool
+        )
+
+    def save_state(self, export_csv: bool = False):
+        """
+        Persist the frame to the parquet state file, and optionally back to the csv.
+        """
+        self._flush_pending_index()
+        state = self.df.rename_axis(self.image_url_col).reset_index()
+        state.to_parquet(self.state_file, engine="pyarrow", compression="zstd")
+        if export_csv:
+            state.to_csv(self.csv_file, index=False)
 
     def get_caption(self, image_path: str) -> str:
         if self.caption_column is None:
             raise ValueError("Cannot retrieve caption from csv, as one is not set.")
-        return self.df.loc[image_path, self.caption_column]
+        return self._caption_map[image_path]
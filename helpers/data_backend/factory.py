@@ -118,6 +118,22 @@ def init_backend_config(backend: dict, args: dict, accelerator) -> dict:
         output["config"]["crop_aspect_buckets"] = backend.get("crop_aspect_buckets")
     else:
         output["config"]["crop_aspect"] = "square"
+    if "resize_resample" in backend:
+        resamplers = ["lanczos", "bicubic", "hamming", "bilinear", "box", "nearest"]
+        if backend["resize_resample"] not in resamplers:
+            raise ValueError(
+                f"(id={backend['id']}) resize_resample must be one of {resamplers}."
+            )
+        output["config"]["resize_resample"] = backend["resize_resample"]
+    if "resize_reducing_gap" in backend:
+        output["config"]["resize_reducing_gap"] = backend["resize_reducing_gap"]
+    if "resize_backend" in backend:
+        resize_backends = ["pil", "batched_torch"]
+        if backend["resize_backend"] not in resize_backends:
+            raise ValueError(
+                f"(id={backend['id']}) resize_backend must be one of {resize_backends}."
+            )
+        output["config"]["resize_backend"] = backend["resize_backend"]
     if "crop_style" in backend:
         crop_styles = ["random", "corner", "center", "centre", "face"]
         if backend["crop_style"] not in crop_styles:
@@ -594,6 +610,7 @@ def configure_multi_databackend(
                 csv_cache_dir=backend["csv_cache_dir"],
                 compress_cache=args.compress_disk_cache,
                 shorten_filenames=backend.get("shorten_filenames", False),
+                max_workers=backend.get("csv_max_workers", 32),
             )
             # init_backend["instance_data_dir"] = backend.get("instance_data_dir", backend.get("instance_data_root", backend.get("csv_cache_dir")))
             init_backend["instance_data_dir"] = None
@@ -926,6 +943,7 @@ def configure_multi_databackend(
                 ),
                 vae_cache_ondemand=args.vae_cache_ondemand,
                 hash_filenames=hash_filenames,
+                resize_backend=init_backend["config"].get("resize_backend", "pil"),
             )
 
             if not args.vae_cache_ondemand:
@@ -1040,6 +1058,7 @@ def get_csv_backend(
     csv_cache_dir: str,
     compress_cache: bool = False,
     shorten_filenames: bool = False,
+    max_workers: int = 32,
 ) -> CSVDataBackend:
     from pathlib import Path
 
@@ -1050,6 +1069,7 @@ def get_csv_backend(
         image_cache_loc=csv_cache_dir,
         compress_cache=compress_cache,
         shorten_filenames=shorten_filenames,
+        max_workers=max_workers,
     )
 
 
@@ -0,0 +1,94 @@
+import logging
+import os
+from collections import defaultdict
+
+import numpy as np
+import torch
+from PIL import Image
+from torchvision.transforms import InterpolationMode
+from torchvision.transforms.v2 import functional as F
+
+logger = logging.getLogger("BatchedResizer")
+logger.setLevel(os.environ.get("SIMPLETUNER_LOG_LEVEL", "INFO"))
+
+
+class BatchedResizer:
+    """
+    Resize many images at once, as stacked uint8 tensors on a torch device.
+
+    Images that share a (source size, target size) pair are resized together in a single
+    antialiased bicubic call, rather than one PIL LANCZOS call per image.
+    """
+
+    def __init__(self, device: str = None):
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.device = torch.device(device)
+
+    def resize(self, images: list, sizes: list) -> list:
+        """
+        Resize each image to its corresponding size.
+
+        Args:
+            images (list[Image.Image]): RGB PIL images.
+            sizes (list[tuple]): The target size of each image as (width, height).
+        Returns:
+            list[Image.Image]: The resized images, in the same order as the input.
+        """
+        if len(images) != len(sizes):
+            raise ValueError(
+                f"Received {len(images)} images but {len(sizes)} target sizes."
+            )
+        results = list(images)
+        groups = defaultdict(list)
+        for idx, (image, size) in enumerate(zip(images, sizes)):
+            size = (int(size[0]), int(size[1]))
+            if image.size == size:
+                continue
+            groups[(image.size, size)].append(idx)
+
+        for (_, (width, height)), indices in groups.items():
+            logger.debug(f"Resizing {len(indices)} images to {width}x{height}")
+            batch = torch.from_numpy(
+                np.stack([np.asarray(images[idx].convert("RGB")) for idx in indices])
+            )
+            # (B, H, W, 3) -> (B, 3, H, W)
+            batch = batch.to(self.device, non_blocking=True).permute(0, 3, 1, 2)
+            resized = F.resize(
+                batch,
+                [height, width],
+                interpolation=InterpolationMode.BICUBIC,
+                antialias=True,
+            )
+            resized = resized.permute(0, 2, 3, 1).contiguous().cpu().numpy()
+            for idx, pixels in zip(indices, resized):
+                results[idx] = Image.fromarray(pixels)
+
+        return results
+
+    def resize_samples(self, samples: list) -> list:
+        """
+        Apply the intermediary resize of TrainingSamples ahead of prepare(), as one batch.
+
+        Only samples with trusted metadata, pixels and cropping disabled are handled here, as their
+        intermediary size is known up front. TrainingSample.resize() skips images already at that size.
+
+        Args:
+            samples (list[TrainingSample]): The samples to resize.
+        Returns:
+            list[TrainingSample]: The same samples.
+        """
+        pending = [
+            sample
+            for sample in samples
+            if sample.image is not None
+            and sample.valid_metadata
+            and not sample.crop_enabled
+        ]
+        if not pending:
+            return samples
+        images = [sample.correct_image().image for sample in pending]
+        sizes = [sample.intermediary_size for sample in pending]
+        for sample, image in zip(pending, self.resize(images, sizes)):
+            sample.image = image
+        return samples
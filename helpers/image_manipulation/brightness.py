@@ -1,14 +1,38 @@
 import multiprocessing
 
 import numpy as np
-from PIL import Image
+from PIL import Image, ImageStat
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+if njit is not None:
+
+    @njit(parallel=True, cache=True, fastmath=True)
+    def _luma_kernel(buf):
+        # buf is an (N, 3) uint8 view; stay in integer accumulators until the divide.
+        s = 0
+        for i in prange(buf.shape[0]):
+            s += 299 * buf[i, 0] + 587 * buf[i, 1] + 114 * buf[i, 2]
+        return s / (1000.0 * buf.shape[0])
+
+    # Without a signature, njit compiles on the first call rather than at import, so
+    # processes that import this module without measuring brightness skip the JIT.
+else:
+    _luma_kernel = None
 
 
 def calculate_luminance(img: Image.Image):
-    np_img = np.asarray(img.convert("RGB"))
-    r, g, b = np_img[:, :, 0], np_img[:, :, 1], np_img[:, :, 2]
-    luminance = 0.299 * r + 0.587 * g + 0.114 * b
-    avg_luminance = np.mean(luminance)
+    if _luma_kernel is not None and img.mode == "RGB":
+        # A single fused pass over the RGB buffer, without the L-mode copy.
+        return float(_luma_kernel(np.asarray(img).reshape(-1, 3)))
+    # PIL's "L" conversion applies the ITU-R BT.601 weights (299/587/114) in C,
+    # and ImageStat reduces the single uint8 plane without a python-level pass.
+    if img.mode != "L":
+        img = img.convert("L")
+    avg_luminance = ImageStat.Stat(img).mean[0]
     return avg_luminance
 
 
@@ -49,27 +49,45 @@ def decode_image_with_opencv(nparr: np.ndarray) -> Union[Image.Image, None]:
 def decode_image_with_pil(img_data: bytes) -> Image.Image:
     try:
         if isinstance(img_data, bytes):
-            img_pil = Image.open(BytesIO(img_data))
-        else:
-            img_pil = Image.open(img_data)
-
-        if img_pil.mode not in ["RGB", "RGBA"] and "transparency" in img_pil.info:
-            img_pil = img_pil.convert("RGBA")
-
-        # For transparent images, add a white background as this is correct
-        # most of the time.
-        if img_pil.mode == "RGBA":
-            canvas = Image.new("RGBA", img_pil.size, (255, 255, 255))
-            canvas.alpha_composite(img_pil)
-            img_pil = canvas.convert("RGB")
-        else:
-            img_pil = img_pil.convert("RGB")
+            img_data = BytesIO(img_data)
+
+        # The returned image is always a converted copy, so the source can be closed
+        # straight away, releasing its file handle and decode buffers.
+        with Image.open(img_data) as source:
+            img_pil = source
+            if img_pil.mode not in ["RGB", "RGBA"] and "transparency" in img_pil.info:
+                img_pil = img_pil.convert("RGBA")
+
+            # For transparent images, add a white background as this is correct
+            # most of the time.
+            if img_pil.mode == "RGBA":
+                canvas = Image.new("RGBA", img_pil.size, (255, 255, 255))
+                canvas.alpha_composite(img_pil)
+                img_pil = canvas.convert("RGB")
+            else:
+                img_pil = img_pil.convert("RGB")
     except (OSError, Image.DecompressionBombError, ValueError) as e:
         logger.warning(f"Error decoding image: {e}")
         raise
     return img_pil
 
 
+def image_has_alpha(img_data: bytes) -> bool:
+    """
+    Check whether an image carries transparency, using only its header.
+
+    This avoids fully decoding the pixel data just to count the channels.
+    """
+    try:
+        with Image.open(BytesIO(img_data)) as img_pil:
+            return (
+                img_pil.mode in ["RGBA", "LA", "PA"] or "transparency" in img_pil.info
+            )
+    except Exception:
+        # PIL can't identify it; let OpenCV try to decode it instead.
+        return False
+
+
 def load_image(img_data: Union[bytes, IO[Any], str]) -> Image.Image:
     """
     Load an image using CV2. If that fails, fall back to PIL.
@@ -83,19 +101,10 @@ def load_image(img_data: Union[bytes, IO[Any], str]) -> Image.Image:
         # Check if it's file-like object.
         img_data = img_data.read()
 
-    # Preload the image bytes with channels unchanged and ensure determine
-    # if the image has an alpha channel. If it does we should add a white
+    # Determine if the image has an alpha channel. If it does we should add a white
     # background to it using PIL.
     nparr = np.frombuffer(img_data, np.uint8)
-    image_preload = cv2.imdecode(nparr, cv2.IMREAD_UNCHANGED)
-    has_alpha = False
-    if (
-        image_preload is not None
-        and len(image_preload.shape) >= 3
-        and image_preload.shape[2] == 4
-    ):
-        has_alpha = True
-    del image_preload
+    has_alpha = image_has_alpha(img_data)
 
     img = None
     if not has_alpha:
@@ -1,14 +1,52 @@
 from PIL import Image
 from PIL.ImageOps import exif_transpose
-from helpers.multiaspect.image import MultiaspectImage, resize_helpers
+from helpers.multiaspect.image import (
+    MultiaspectImage,
+    resize_helpers,
+    target_size_batch_helpers,
+)
 from helpers.image_manipulation.cropping import crop_handlers
 from helpers.training.state_tracker import StateTracker
 from helpers.training.multi_process import should_log
 import logging
+import numbers
 import os
 from tqdm import tqdm
 import random
 import time
+from functools import lru_cache
+from operator import itemgetter
+import numpy as np
+
+EXIF_ORIENTATION_TAG = 0x0112
+# Metadata keys that let prepare() skip its size calculations.
+REQUIRED_METADATA_KEYS = frozenset(
+    (
+        "original_size",
+        "target_size",
+        "intermediary_size",
+        "crop_coordinates",
+        "aspect_ratio",
+    )
+)
+_get_required_metadata = itemgetter(
+    "original_size",
+    "target_size",
+    "intermediary_size",
+    "crop_coordinates",
+    "aspect_ratio",
+)
+# Resampling filters that may be chosen through the dataloader's resize_resample option.
+RESIZE_RESAMPLERS = {
+    "lanczos": Image.Resampling.LANCZOS,
+    "bicubic": Image.Resampling.BICUBIC,
+    "hamming": Image.Resampling.HAMMING,
+    "bilinear": Image.Resampling.BILINEAR,
+    "box": Image.Resampling.BOX,
+    "nearest": Image.Resampling.NEAREST,
+}
+# Read once at import, rather than on every save_debug_image() call.
+DEBUG_IMAGE_PREP = os.environ.get("SIMPLETUNER_DEBUG_IMAGE_PREP", "") == "true"
 
 logger = logging.getLogger(__name__)
 if should_log():
@@ -17,7 +55,105 @@ else:
     logger.setLevel("ERROR")
 
 
+ASPECT_BUCKETS_ERROR = (
+    "Aspect buckets must be a list of floats or dictionaries."
+    " If using a dictionary, it is expected to be in the format {'aspect': 1.0, 'weight': 0.5}."
+    " To provide multiple aspect ratios, use a list of dictionaries: [{'aspect': 1.0, 'weight': 0.5}, {'aspect': 1.5, 'weight': 0.5}]."
+)
+
+
+@lru_cache(maxsize=None)
+def _aspect_bucket_table(buckets: tuple, weighted: bool):
+    """
+    Normalise crop_aspect_buckets into one structured array, once per configuration rather than once per sample.
+
+    Args:
+        buckets (tuple): The (aspect, weight) pairs from crop_aspect_buckets.
+        weighted (bool): Whether the buckets were given as weighted dictionaries.
+    Returns:
+        tuple:
+            - The buckets (np.ndarray), with "aspect", "weight" and normalised cumulative "cdf" fields.
+            - Whether any portrait buckets exist (bool).
+            - Whether any landscape buckets exist (bool).
+    """
+    table = np.zeros(
+        len(buckets), dtype=[("aspect", "f8"), ("weight", "f8"), ("cdf", "f8")]
+    )
+    table["aspect"] = [aspect for aspect, _ in buckets]
+    table["weight"] = [weight for _, weight in buckets]
+    if weighted and not np.isclose(table["weight"].sum(), 1.0):
+        raise ValueError("The weights of aspect buckets must add up to 1.")
+    table["cdf"] = np.cumsum(table["weight"])
+    table["cdf"] /= table["cdf"][-1]
+    return (
+        table,
+        bool((table["aspect"] < 1.0).any()),
+        bool((table["aspect"] > 1.0).any()),
+    )
+
+
+def _normalise_aspect_buckets(crop_aspect_buckets: list):
+    """
+    Convert crop_aspect_buckets into the hashable form used by _aspect_bucket_table.
+
+    Returns:
+        tuple: The (aspect, weight) pairs, and whether the buckets are weighted.
+    """
+    weighted = type(crop_aspect_buckets[0]) is dict
+    buckets = []
+    for bucket in crop_aspect_buckets:
+        if weighted and type(bucket) is dict:
+            buckets.append((float(bucket["aspect"]), float(bucket["weight"])))
+        elif not weighted and isinstance(bucket, numbers.Real):
+            # Integer buckets such as 1 are as valid as 1.0.
+            buckets.append((float(bucket), 1.0))
+        else:
+            raise ValueError(ASPECT_BUCKETS_ERROR)
+    return tuple(buckets), weighted
+
+
 class TrainingSample:
+    # One of these is built per image, so avoid a per-instance __dict__.
+    __slots__ = (
+        "image",
+        "target_size",
+        "intermediary_size",
+        "original_size",
+        "data_backend_id",
+        "image_metadata",
+        "original_aspect_ratio",
+        "current_size",
+        "data_backend_config",
+        "crop_enabled",
+        "crop_style",
+        "crop_aspect",
+        "crop_aspect_buckets",
+        "crop_coordinates",
+        "cropper",
+        "resolution",
+        "resolution_type",
+        "target_size_calculator",
+        "target_size_batch_calculator",
+        "target_downsample_size",
+        "maximum_image_size",
+        "resize_resample",
+        "resize_reducing_gap",
+        "valid_metadata",
+        "aspect_ratio",
+        "target_area",
+        "pixel_resolution",
+        "megapixel_resolution",
+        "target_aspect_ratio",
+        "_image_path",
+        "_corrected",
+        "_original_area",
+        "_aspect_ratio_cache",
+        "_aspect_buckets",
+        "_weighted_aspect_buckets",
+        "_has_portrait_buckets",
+        "_has_landscape_buckets",
+    )
+
     def __init__(
         self,
         image: Image.Image,
@@ -37,30 +173,23 @@ class TrainingSample:
         self.target_size = None
         self.intermediary_size = None
         self.original_size = None
+        self._aspect_ratio_cache = None
         self.data_backend_id = data_backend_id
         self.image_metadata = (
             image_metadata
             if image_metadata
             else StateTracker.get_metadata_by_filepath(image_path, data_backend_id)
         )
+        # original_aspect_ratio is calculated once, in _validate_image_metadata().
         if hasattr(image, "size"):
             self.original_size = self.image.size
-            self.original_aspect_ratio = MultiaspectImage.calculate_image_aspect_ratio(
-                self.original_size
-            )
         elif image_metadata is not None:
             self.original_size = image_metadata.get("original_size")
-            self.original_aspect_ratio = MultiaspectImage.calculate_image_aspect_ratio(
-                self.original_size
-            )
         self.current_size = self.original_size
 
         if not self.original_size:
             raise Exception("Original size not found in metadata.")
 
-        # Torchvision transforms turn the pixels into a Tensor and normalize them for the VAE.
-        self.transforms = MultiaspectImage.get_image_transforms()
-
         # Backend config details
         self.data_backend_config = StateTracker.get_data_backend_config(data_backend_id)
         self.crop_enabled = self.data_backend_config.get("crop", False)
@@ -69,6 +198,16 @@ class TrainingSample:
         self.crop_aspect_buckets = self.data_backend_config.get(
             "crop_aspect_buckets", []
         )
+        self._aspect_buckets = None
+        if self.crop_aspect == "random" and len(self.crop_aspect_buckets) > 0:
+            buckets, self._weighted_aspect_buckets = _normalise_aspect_buckets(
+                self.crop_aspect_buckets
+            )
+            (
+                self._aspect_buckets,
+                self._has_portrait_buckets,
+                self._has_landscape_buckets,
+            ) = _aspect_bucket_table(buckets, self._weighted_aspect_buckets)
         self.crop_coordinates = (0, 0)
         crop_handler_cls = crop_handlers.get(self.crop_style)
         if not crop_handler_cls:
@@ -79,6 +218,9 @@ class TrainingSample:
         self.target_size_calculator = resize_helpers.get(self.resolution_type)
         if self.target_size_calculator is None:
             raise ValueError(f"Unknown resolution type: {self.resolution_type}")
+        self.target_size_batch_calculator = target_size_batch_helpers.get(
+            self.resolution_type
+        )
         self._set_resolution()
         self.target_downsample_size = self.data_backend_config.get(
             "target_downsample_size", None
@@ -86,13 +228,21 @@ class TrainingSample:
         self.maximum_image_size = self.data_backend_config.get(
             "maximum_image_size", None
         )
+        self.resize_resample = RESIZE_RESAMPLERS[
+            self.data_backend_config.get("resize_resample", "lanczos")
+        ]
+        self.resize_reducing_gap = self.data_backend_config.get(
+            "resize_reducing_gap", None
+        )
         self._image_path = image_path
-        # RGB/EXIF conversions.
-        self.correct_image()
+        # RGB/EXIF conversions are deferred until the pixels are needed, see correct_image().
+        self._corrected = False
         self._validate_image_metadata()
 
     def save_debug_image(self, path: str):
-        if self.image and os.environ.get("SIMPLETUNER_DEBUG_IMAGE_PREP", "") == "true":
+        if not DEBUG_IMAGE_PREP:
+            return self
+        if self.image:
             self.image.save(path)
         return self
 
@@ -120,35 +270,43 @@ class TrainingSample:
         Returns:
             bool: True if the metadata is valid, False otherwise.
         """
-        required_keys = [
-            "original_size",
-            "target_size",
-            "intermediary_size",
-            "crop_coordinates",
-            "aspect_ratio",
-        ]
-        if type(self.image_metadata) is not dict:
-            self.valid_metadata = False
-        else:
-            self.valid_metadata = all(
-                key in self.image_metadata for key in required_keys
-            )
-        if self.valid_metadata:
-            self.original_size = self.image_metadata["original_size"]
-            self.target_size = self.image_metadata["target_size"]
-            self.intermediary_size = self.image_metadata["intermediary_size"]
-            self.crop_coordinates = self.image_metadata["crop_coordinates"]
-            self.aspect_ratio = self.image_metadata["aspect_ratio"]
-
-        self.original_aspect_ratio = MultiaspectImage.calculate_image_aspect_ratio(
-            self.original_size
+        image_metadata = self.image_metadata
+        # A single keys-view comparison and itemgetter call, rather than a lookup per key.
+        self.valid_metadata = (
+            type(image_metadata) is dict
+            and image_metadata.keys() >= REQUIRED_METADATA_KEYS
         )
+        if self.valid_metadata:
+            (
+                self.original_size,
+                self.target_size,
+                self.intermediary_size,
+                self.crop_coordinates,
+                self.aspect_ratio,
+            ) = _get_required_metadata(image_metadata)
 
         if not self.valid_metadata and hasattr(self.image, "size"):
-            self.original_size = self.image.size
+            self.original_size = self._oriented_size()
+        # original_size is final from here on, so its aspect ratio only needs calculating once.
+        self.original_aspect_ratio = self._aspect_ratio_of(self.original_size)
+        self._original_area = self.original_size[0] * self.original_size[1]
 
         return self.valid_metadata
 
+    def _aspect_ratio_of(self, size):
+        """
+        Calculate the aspect ratio of a (width, height) size, reusing the last result for an unchanged size.
+
+        Returns:
+            float: The rounded aspect ratio.
+        """
+        cached = self._aspect_ratio_cache
+        if cached is not None and cached[0] == size:
+            return cached[1]
+        aspect_ratio = MultiaspectImage.calculate_image_aspect_ratio(size)
+        self._aspect_ratio_cache = (size, aspect_ratio)
+        return aspect_ratio
+
     def _set_resolution(self):
         if self.resolution_type == "pixel":
             self.target_area = self.resolution
@@ -175,18 +333,20 @@ class TrainingSample:
         Returns:
             list[float]: The list of available aspect buckets
         """
+        aspects = self._aspect_buckets["aspect"]
+        if self.target_size_batch_calculator is not None:
+            target_widths, target_heights = self.target_size_batch_calculator(
+                aspects, self.resolution, self.original_size
+            )
+            # Check the sizes vs a 20% threshold, for every bucket at once.
+            mask = (target_widths * 1.2 < self.original_size[0]) & (
+                target_heights * 1.2 < self.original_size[1]
+            )
+            return aspects[mask].tolist()
         available_buckets = []
-        for bucket in self.crop_aspect_buckets:
+        for aspect in aspects.tolist():
             # We want to ensure we don't upscale images beyond about 20% of their original size.
             # If any of the aspect buckets will result in that, we'll ignore it.
-            if type(bucket) is dict:
-                aspect = bucket["aspect_ratio"]
-            elif type(bucket) is float:
-                aspect = bucket
-            else:
-                raise ValueError(
-                    "Aspect buckets must be a list of floats or dictionaries."
-                )
             # Calculate new size
             target_size, intermediary_size, aspect_ratio = self.target_size_calculator(
                 aspect, self.resolution, self.original_size
@@ -213,60 +373,31 @@ class TrainingSample:
         if self.valid_metadata:
             self.aspect_ratio = self.image_metadata["aspect_ratio"]
             return self.aspect_ratio
+        # our aspect ratio is w / h
+        # so portrait is < 1.0 and landscape is > 1.0
+        if not self._has_portrait_buckets or not self._has_landscape_buckets:
+            return 1.0
         if (
-            len(self.crop_aspect_buckets) > 0
-            and type(self.crop_aspect_buckets[0]) is dict
+            not self._has_portrait_buckets
+            and self.aspect_ratio < 1.0
+            or not self._has_landscape_buckets
+            and self.aspect_ratio > 1.0
         ):
-            has_portrait_buckets = any(
-                bucket["aspect"] < 1.0 for bucket in self.crop_aspect_buckets
+            logger.warning(
+                f"No {'portrait' if self.aspect_ratio < 1.0 else 'landscape'} aspect buckets found, defaulting to 1.0 square crop. Define a {'portrait' if self.aspect_ratio < 1.0 else 'landscape'} aspect bucket to avoid this warning"
             )
-            has_landscape_buckets = any(
-                bucket["aspect"] > 1.0 for bucket in self.crop_aspect_buckets
+            return 1.0
+        if self._weighted_aspect_buckets:
+            # Inverse CDF sampling; random.random() keeps this on the seeded python RNG.
+            index = np.searchsorted(
+                self._aspect_buckets["cdf"], random.random(), side="right"
             )
-            # our aspect ratio is w / h
-            # so portrait is < 1.0 and landscape is > 1.0
-            if not has_portrait_buckets or not has_landscape_buckets:
-                return 1.0
-            if (
-                not has_portrait_buckets
-                and self.aspect_ratio < 1.0
-                or not has_landscape_buckets
-                and self.aspect_ratio > 1.0
-            ):
-                logger.warning(
-                    f"No {'portrait' if self.aspect_ratio < 1.0 else 'landscape'} aspect buckets found, defaulting to 1.0 square crop. Define a {'portrait' if self.aspect_ratio < 1.0 else 'landscape'} aspect bucket to avoid this warning"
-                )
-                return 1.0
-            total_weight = sum(bucket["weight"] for bucket in self.crop_aspect_buckets)
-            if total_weight != 1.0:
-                raise ValueError("The weights of aspect buckets must add up to 1.")
-
-            aspects = [bucket["aspect"] for bucket in self.crop_aspect_buckets]
-            weights = [bucket["weight"] for bucket in self.crop_aspect_buckets]
-
-            selected_aspect = random.choices(aspects, weights)[0]
-        elif (
-            len(self.crop_aspect_buckets) > 0
-            and type(self.crop_aspect_buckets[0]) is float
-        ):
-            has_landscape_buckets = any(
-                bucket > 1.0 for bucket in self.crop_aspect_buckets
+            selected_aspect = float(
+                self._aspect_buckets["aspect"][
+                    min(index, len(self._aspect_buckets) - 1)
+                ]
             )
-            has_portrait_buckets = any(
-                bucket < 1.0 for bucket in self.crop_aspect_buckets
-            )
-            if not has_portrait_buckets or not has_landscape_buckets:
-                return 1.0
-            if (
-                not has_portrait_buckets
-                and self.aspect_ratio < 1.0
-                or not has_landscape_buckets
-                and self.aspect_ratio > 1.0
-            ):
-                logger.warning(
-                    f"No {'portrait' if self.aspect_ratio < 1.0 else 'landscape'} aspect buckets found, defaulting to 1.0 square crop. Define a {'portrait' if self.aspect_ratio < 1.0 else 'landscape'} aspect bucket to avoid this warning"
-                )
-                return 1.0
+        else:
             # filter to portrait or landscape buckets, depending on our aspect ratio
             available_aspects = self._trim_aspect_bucket_list()
             if len(available_aspects) == 0:
@@ -277,12 +408,6 @@ class TrainingSample:
                     )
             else:
                 selected_aspect = random.choice(available_aspects)
-        else:
-            raise ValueError(
-                "Aspect buckets must be a list of floats or dictionaries."
-                " If using a dictionary, it is expected to be in the format {'aspect': 1.0, 'weight': 0.5}."
-                " To provide multiple aspect ratios, use a list of dictionaries: [{'aspect': 1.0, 'weight': 0.5}, {'aspect': 1.5, 'weight': 0.5}]."
-            )
 
         return selected_aspect
 
@@ -298,17 +423,21 @@ class TrainingSample:
             - crop_coordinates (tuple)
             - aspect_ratio (float)
         """
-        self.save_debug_image(f"images/{time.time()}-0-original.png")
+        self.correct_image()
+        if DEBUG_IMAGE_PREP:
+            self.save_debug_image(f"images/{time.time()}-0-original.png")
         self.crop()
-        self.save_debug_image(f"images/{time.time()}-1-cropped.png")
+        if DEBUG_IMAGE_PREP:
+            self.save_debug_image(f"images/{time.time()}-1-cropped.png")
         if not self.crop_enabled:
-            self.save_debug_image(f"images/{time.time()}-1b-nocrop-resize.png")
+            if DEBUG_IMAGE_PREP:
+                self.save_debug_image(f"images/{time.time()}-1b-nocrop-resize.png")
             self.resize()
 
         image = self.image
         if return_tensor:
             # Return normalised tensor.
-            image = self.transforms(image)
+            image = MultiaspectImage.image_to_tensor(image)
         webhook_handler = StateTracker.get_webhook_handler()
         prepared_sample = PreparedSample(
             image=image,
@@ -337,7 +466,7 @@ class TrainingSample:
         if self.image is not None:
             return self.image.size[0] * self.image.size[1]
         if self.original_size:
-            return self.original_size[0] * self.original_size[1]
+            return self._original_area
 
     def _should_resize_before_crop(self) -> bool:
         """
@@ -352,27 +481,20 @@ class TrainingSample:
             or not self.target_downsample_size
         ):
             return False
-        if self.data_backend_config.get("resolution_type") == "pixel":
-            return (
-                self.current_size[0] > self.pixel_resolution
-                or self.current_size[1] > self.pixel_resolution
-            ) or (
-                self.current_size[0] < self.pixel_resolution
-                or self.current_size[1] < self.pixel_resolution
-            )
-        elif self.data_backend_config.get("resolution_type") == "area":
+        width, height = self.current_size
+        if self.resolution_type == "pixel":
+            # Any edge above or below the resolution needs a resize.
+            return width != self.pixel_resolution or height != self.pixel_resolution
+        elif self.resolution_type == "area":
             should_resize = (
-                self.area() > self.target_area
-                or self.area() < self.target_area
-                or self.current_size[0] < self.target_size[0]
-                or self.current_size[1] < self.target_size[1]
+                self.area() != self.target_area
+                or width < self.target_size[0]
+                or height < self.target_size[1]
             )
             logger.debug(f"Should resize? {should_resize}")
             return should_resize
         else:
-            raise ValueError(
-                f"Unknown resolution type: {self.data_backend_config.get('resolution_type')}"
-            )
+            raise ValueError(f"Unknown resolution type: {self.resolution_type}")
 
     def _calculate_target_downsample_size(self):
         """
@@ -447,14 +569,15 @@ class TrainingSample:
                 - The intermediary size as (width, height).
                 - The aspect ratio of the target size. This will likely be different from the original aspect ratio.
         """
-        self.aspect_ratio = MultiaspectImage.calculate_image_aspect_ratio(
-            self.original_size
-        )
+        # Bound once, as this runs for every sample.
+        calculate_new_size = self.target_size_calculator
+        original_size = self.original_size
+        self.aspect_ratio = self.original_aspect_ratio
         if self.crop_enabled:
             if self.crop_aspect == "square":
                 self.target_size = (self.pixel_resolution, self.pixel_resolution)
-                _, self.intermediary_size, _ = self.target_size_calculator(
-                    self.aspect_ratio, self.resolution, self.original_size
+                _, self.intermediary_size, _ = calculate_new_size(
+                    self.aspect_ratio, self.resolution, original_size
                 )
                 self.aspect_ratio = 1.0
                 self.correct_intermediary_square_size()
@@ -469,15 +592,11 @@ class TrainingSample:
             # Grab a random aspect ratio from a list.
             self.aspect_ratio = self._select_random_aspect()
         self.target_size, calculated_intermediary_size, self.aspect_ratio = (
-            self.target_size_calculator(
-                self.aspect_ratio, self.resolution, self.original_size
-            )
+            calculate_new_size(self.aspect_ratio, self.resolution, original_size)
         )
         if self.crop_aspect != "random" or not self.valid_metadata:
             self.intermediary_size = calculated_intermediary_size
-        self.aspect_ratio = MultiaspectImage.calculate_image_aspect_ratio(
-            self.target_size
-        )
+        self.aspect_ratio = self._aspect_ratio_of(self.target_size)
         self.correct_intermediary_square_size()
         if self.aspect_ratio == 1.0:
             self.target_size = (self.pixel_resolution, self.pixel_resolution)
@@ -488,17 +607,40 @@ class TrainingSample:
             self.aspect_ratio,
         )
 
+    def _oriented_size(self):
+        """
+        Return the image size after its EXIF orientation is applied, without touching the pixels.
+
+        Returns:
+            tuple: The size as (width, height).
+        """
+        width, height = self.image.size
+        if self._corrected:
+            return width, height
+        # Orientations 5-8 involve a 90 degree rotation, swapping the edges.
+        if self.image.getexif().get(EXIF_ORIENTATION_TAG, 1) in (5, 6, 7, 8):
+            return height, width
+        return width, height
+
     def correct_image(self):
         """
         Apply a series of transformations to the image to "correct" it, such as EXIF rotation and conversion to RGB.
+        This only runs once, when the pixels are first needed, so metadata-only work never decodes the image.
 
         Returns:
             TrainingSample: The current TrainingSample instance.
         """
-        if self.image:
-            # Convert image to RGB to remove any alpha channel and apply EXIF data transformations
-            self.image = self.image.convert("RGB")
-            self.image = exif_transpose(self.image)
+        if self._corrected or self.image is None:
+            return self
+        self._corrected = True
+        image = self.image
+        # Convert image to RGB to remove any alpha channel and apply EXIF data transformations.
+        # Both return a full copy even when they have nothing to do, so only call them when needed.
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        if image.getexif().get(EXIF_ORIENTATION_TAG, 1) != 1:
+            image = exif_transpose(image)
+        self.image = image
         return self
 
     def crop(self):
@@ -511,19 +653,25 @@ class TrainingSample:
         """
         if not self.crop_enabled:
             return self
+        self.correct_image()
+        # Trusted metadata already carries the target size, as in resize().
+        if not self.valid_metadata:
+            self.calculate_target_size()
         # Too-big of an image, resize before we crop.
-        self.calculate_target_size()
         self._downsample_before_crop()
-        self.save_debug_image(f"images/{time.time()}-0.5-downsampled.png")
-        if self.image is not None:
-            logger.debug(f"setting image: {self.image.size}")
-            self.cropper.set_image(self.image)
-        logger.debug(f"Cropper size updating to {self.current_size}")
-        self.cropper.set_intermediary_size(self.current_size[0], self.current_size[1])
-        self.image, self.crop_coordinates = self.cropper.crop(
-            self.target_size[0], self.target_size[1]
-        )
-        self.current_size = self.target_size
+        if DEBUG_IMAGE_PREP:
+            self.save_debug_image(f"images/{time.time()}-0.5-downsampled.png")
+        cropper = self.cropper
+        image = self.image
+        current_size = self.current_size
+        target_size = self.target_size
+        if image is not None:
+            logger.debug(f"setting image: {image.size}")
+            cropper.set_image(image)
+        logger.debug(f"Cropper size updating to {current_size}")
+        cropper.set_intermediary_size(current_size[0], current_size[1])
+        self.image, self.crop_coordinates = cropper.crop(target_size[0], target_size[1])
+        self.current_size = target_size
         logger.debug(
             f"Cropped to {self.image.size if self.image is not None else self.current_size} via crop coordinates {self.crop_coordinates} {'resulting in current_size of' if self.image is not None else ''} {self.current_size if self.image is not None else ''}"
         )
@@ -538,45 +686,62 @@ class TrainingSample:
         Returns:
             TrainingSample: The current TrainingSample instance.
         """
+        self.correct_image()
         current_size = self.image.size if self.image is not None else self.original_size
         if size is None:
             if not self.valid_metadata:
                 self.target_size, self.intermediary_size, self.target_aspect_ratio = (
                     self.calculate_target_size()
                 )
-            size = self.target_size
-            if self.target_size != self.intermediary_size:
+            target_size = self.target_size
+            intermediary_size = self.intermediary_size
+            size = target_size
+            if target_size != intermediary_size:
                 logger.debug(
-                    f"we have to crop because target size {self.target_size} != intermediary size {self.intermediary_size}"
+                    f"we have to crop because target size {target_size} != intermediary size {intermediary_size}"
                 )
-                # Now we can resize the image to the intermediary size.
-                if self.image is not None:
-                    self.image = self.image.resize(
-                        self.intermediary_size, Image.Resampling.LANCZOS
-                    )
-                self.current_size = self.intermediary_size
-                if self.image is not None and self.cropper:
-                    self.cropper.set_image(self.image)
-                self.cropper.set_intermediary_size(
-                    self.intermediary_size[0], self.intermediary_size[1]
+                cropper = self.cropper
+                image = self.image
+                # Now we can resize the image to the intermediary size, unless a BatchedResizer already did.
+                if image is not None and image.size != tuple(intermediary_size):
+                    image = self._resize_image(image, intermediary_size)
+                    self.image = image
+                self.current_size = intermediary_size
+                if image is not None and cropper:
+                    cropper.set_image(image)
+                cropper.set_intermediary_size(
+                    intermediary_size[0], intermediary_size[1]
                 )
-                self.image, self.crop_coordinates = self.cropper.crop(
-                    self.target_size[0], self.target_size[1]
+                self.image, self.crop_coordinates = cropper.crop(
+                    target_size[0], target_size[1]
                 )
                 logger.debug(f"crop coordinates: {self.crop_coordinates}")
                 return self
 
-        if self.image and hasattr(self.image, "resize"):
-            self.image = self.image.resize(size, Image.Resampling.LANCZOS)
-            self.aspect_ratio = MultiaspectImage.calculate_image_aspect_ratio(
-                self.image.size
-            )
+        image = self.image
+        if image and hasattr(image, "resize"):
+            if image.size != tuple(size):
+                image = self._resize_image(image, size)
+                self.image = image
+            self.aspect_ratio = self._aspect_ratio_of(image.size)
         self.current_size = size
         logger.debug(
             f"Resized to {self.current_size} (aspect ratio: {self.aspect_ratio})"
         )
         return self
 
+    def _resize_image(self, image: Image.Image, size: tuple):
+        """
+        Resize an image with the configured resampling filter.
+        With a reducing_gap, large downsamples first take a fast integer reduce() pass before the filter runs.
+
+        Returns:
+            Image.Image: The resized image.
+        """
+        return image.resize(
+            size, self.resize_resample, reducing_gap=self.resize_reducing_gap
+        )
+
     def get_image(self):
         """
         Returns the current state of the image.
@@ -585,7 +750,7 @@ class TrainingSample:
         Returns:
             Image.Image: The current image.
         """
-        return self.image
+        return self.correct_image().image
 
     def get_conditioning_image(self):
         """
@@ -630,6 +795,16 @@ class TrainingSample:
 
 
 class PreparedSample:
+    __slots__ = (
+        "image",
+        "image_metadata",
+        "original_size",
+        "intermediary_size",
+        "target_size",
+        "aspect_ratio",
+        "crop_coordinates",
+    )
+
     def __init__(
         self,
         image: Image.Image,
@@ -652,9 +827,12 @@ class PreparedSample:
         self.original_size = original_size
         self.intermediary_size = intermediary_size
         self.target_size = target_size
-        if image is not None and hasattr(image, "size") and type(image.size) is tuple:
+        # Tensors have a size() method rather than a tuple, and use the given aspect ratio.
+        image_size = getattr(image, "size", None)
+        if type(image_size) is tuple:
+            # Pass the (W, H) size itself; the result must stay rounded, as it is used as the bucket key.
             self.aspect_ratio = MultiaspectImage.calculate_image_aspect_ratio(
-                image.size[0] / image.size[1]
+                image_size
             )
         else:
             self.aspect_ratio = aspect_ratio
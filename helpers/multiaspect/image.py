@@ -1,3 +1,4 @@
+import torch
 from torchvision import transforms
 from PIL import Image
 import logging
@@ -20,6 +21,34 @@ class MultiaspectImage:
             ]
         )
 
+    @staticmethod
+    def image_to_tensor(
+        image: Image.Image, device=None, dtype: torch.dtype = torch.float32
+    ):
+        """
+        Convert an image into a CHW tensor normalised to [-1, 1].
+
+        This matches get_image_transforms(), but skips the intermediate float copies that
+        ToTensor() and Normalize() each make. The uint8 pixels are moved to the device before
+        they're cast, which is a quarter of the bytes of a float32 transfer.
+
+        Args:
+            image (PIL.Image): The image to convert.
+            device (torch.device): Optional device to place the tensor on.
+            dtype (torch.dtype): The output dtype. Normalisation happens in float32 first.
+
+        Returns:
+            torch.Tensor: The normalised image tensor.
+        """
+        pixels = torch.from_numpy(np.array(image, dtype=np.uint8, copy=True))
+        if pixels.ndim == 2:
+            pixels = pixels.unsqueeze(-1)
+        if device is not None:
+            pixels = pixels.to(device, non_blocking=True)
+        # x / 255 then (x - 0.5) / 0.5 is x / 127.5 - 1.
+        tensor = pixels.permute(2, 0, 1).to(torch.float32).div_(127.5).sub_(1.0)
+        return tensor.contiguous().to(dtype)
+
     @staticmethod
     def _round_to_nearest_multiple(value):
         """Round a value to the nearest multiple."""
@@ -100,6 +129,38 @@ class MultiaspectImage:
 
         return (W_adjusted, H_adjusted), (W_initial, H_initial), adjusted_aspect_ratio
 
+    @staticmethod
+    def calculate_target_sizes_by_pixel_edge(
+        aspect_ratios: np.ndarray, resolution: int, original_size: tuple
+    ):
+        """
+        Vectorised form of calculate_new_size_by_pixel_edge, for many aspect ratios against one image.
+        Only the target sizes are calculated, as that's all aspect bucket filtering needs.
+
+        Args:
+            aspect_ratios (np.ndarray): The aspect ratios to calculate target sizes for.
+            resolution (int): The pixel edge resolution.
+            original_size (tuple): The original image size as (width, height).
+
+        Returns:
+            tuple: The target widths and heights (np.ndarray).
+        """
+        aspect_ratios = np.asarray(aspect_ratios, dtype=np.float64)
+        W_original, H_original = original_size
+        if W_original < H_original:  # Portrait or square orientation
+            W_initial = np.full(aspect_ratios.shape, resolution, dtype=np.int64)
+            H_initial = (resolution / aspect_ratios).astype(np.int64)
+        else:  # Landscape orientation
+            H_initial = np.full(aspect_ratios.shape, resolution, dtype=np.int64)
+            W_initial = (resolution * aspect_ratios).astype(np.int64)
+
+        # np.round matches python's round(), both rounding half to even.
+        multiple = StateTracker.get_args().aspect_bucket_alignment
+        W_adjusted = np.maximum(np.round(W_initial / multiple) * multiple, multiple)
+        H_adjusted = np.maximum(np.round(H_initial / multiple) * multiple, multiple)
+
+        return W_adjusted.astype(np.int64), H_adjusted.astype(np.int64)
+
     @staticmethod
     def calculate_new_size_by_pixel_area(
         aspect_ratio: float, megapixels: float, original_size: tuple
@@ -265,3 +326,9 @@ resize_helpers = {
     "pixel": MultiaspectImage.calculate_new_size_by_pixel_edge,
     "area": MultiaspectImage.calculate_new_size_by_pixel_area,
 }
+
+# Vectorised target size calculators, where one exists.
+# The area calculator reads and writes the aspect resolution map as it goes, so it has none.
+target_size_batch_helpers = {
+    "pixel": MultiaspectImage.calculate_target_sizes_by_pixel_edge,
+}
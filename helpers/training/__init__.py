@@ -1,5 +1,6 @@
 quantised_precision_levels = [
     "no_change",
+    "bf16",
     "fp4-bnb",
     "fp8-bnb",
     "fp8-quanto",
@@ -7,3 +8,6 @@ quantised_precision_levels = [
     "int4-quanto",
     "int2-quanto",
 ]
+
+# The attention projections that LoRA adapters are added to.
+lora_target_modules = ["to_k", "to_q", "to_v", "to_out.0"]
@@ -1,4 +1,8 @@
 from helpers.training.multi_process import should_log
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import types
 import logging
 import torch, os
 
@@ -9,62 +13,472 @@ else:
     logger.setLevel(logging.ERROR)
 
 try:
-    from optimum.quanto import freeze, quantize, qfloat8, qint8, qint4, qint2, QTensor
+    from optimum.quanto import freeze, quantize, qfloat8, QTensor
 except ImportError as e:
-    raise ImportError(
-        f"To use Quanto, please install the optimum library: `pip install optimum-quanto`: {e}"
+    # Quanto itself is only needed for fp8 on GPUs without native fp8 support.
+    freeze = quantize = qfloat8 = QTensor = None
+    quanto_import_error = e
+from helpers.caching.memory import reclaim_memory
+from helpers.training import lora_target_modules
+from helpers.training.quantisation.bulk import (
+    bulk_quantise_linears,
+    install_int8_linear,
+)
+from helpers.training.quantisation.cache import (
+    load_quantised_linears,
+    quantisation_cache_path,
+    save_quantised_linears,
+    weight_fingerprint,
+)
+from helpers.training.quantisation.fp8 import (
+    calibrate_activation_scales,
+    enable_delayed_scaling,
+    install_fp8_linear,
+    quantise_linears_to_fp8,
+    supports_native_fp8,
+)
+from helpers.training.quantisation.grouped import (
+    group_quantise_linears,
+    install_grouped_linear,
+)
+
+# Models with fewer Linear parameters than this are left in their original precision.
+MIN_QUANTISATION_PARAMETERS = 1_000_000
+QUANTISATION_WORKERS = 4
+# Prefix of the contiguous buffers holding a model's quantisation scales.
+_SCALES_BUFFER = "_quantised_scales_"
+# The text encoders' fp8 activation scales are calibrated over this many batches of prompts.
+CALIBRATION_BATCHES = 8
+CALIBRATION_BATCH_SIZE = 4
+
+
+def _is_quantised(model):
+    for module in model.modules():
+        weight = getattr(module, "weight", None)
+        if (QTensor is not None and isinstance(weight, QTensor)) or (
+            isinstance(weight, torch.Tensor)
+            and weight.dtype in (torch.float8_e4m3fn, torch.int8, torch.uint8)
+        ):
+            return True
+    return False
+
+
+def _linear_parameter_count(model):
+    return sum(
+        module.weight.numel()
+        for module in model.modules()
+        if isinstance(module, torch.nn.Linear)
     )
 
 
-def _quanto_model(model, model_precision, base_model_precision=None):
-    if model_precision is None:
-        model_precision = base_model_precision
+def _lora_target_names(model, target_modules):
+    """
+    The names of the modules in the model that PEFT will wrap with LoRA adapters.
+    """
+    return {
+        name
+        for name, _ in model.named_modules()
+        if any(
+            name == target or name.endswith(f".{target}") for target in target_modules
+        )
+    }
+
+
+def _grouped_quantiser(bits):
+    def build(model, exclude, activation_scales):
+        return (
+            partial(group_quantise_linears, bits=bits, exclude=exclude),
+            partial(install_grouped_linear, bits=bits),
+        )
+
+    return build
+
+
+def _int8_quantiser(model, exclude, activation_scales, int_mm=False):
+    # Weight-only by default. With int_mm, each call checks its own row count (batch x
+    # tokens) before quantising its activations for torch._int_mm, and stays weight-only
+    # when that is too small for the accelerated kernel.
+    return (
+        partial(bulk_quantise_linears, int_mm=int_mm, exclude=exclude),
+        partial(install_int8_linear, int_mm=int_mm),
+    )
+
+
+def _quanto_quantise_and_freeze(model, weight_quant, exclude=None):
+    """
+    Quantise the model with Quanto one top-level child at a time, freezing each child as
+    soon as it is quantised. Only one child holds both its float and quantised weights at
+    any time, rather than the whole model until a final freeze().
+    """
+    exclude = list(exclude or ())
+    for name, _ in list(model.named_children()):
+        quantize(
+            model, weights=weight_quant, include=[name, f"{name}.*"], exclude=exclude
+        )
+        freeze(getattr(model, name))
+
+
+def _fp8_quantiser(model, exclude, activation_scales):
+    logger.warning(
+        "An earlier experimental build of this code erroneously used int8 instead of fp8. If you are resuming training and see errors, please use int8 instead of fp8."
+    )
+    if not supports_native_fp8(_model_device(model)):
+        if quantize is None:
+            raise ImportError(
+                f"To use Quanto, please install the optimum library: `pip install optimum-quanto`: {quanto_import_error}"
+            )
+        _quanto_quantise_and_freeze(model, qfloat8, exclude)
+        return None
+    # Ada and Hopper run fp8 matmuls natively, rather than dequantising in Quanto.
+    return (
+        partial(
+            quantise_linears_to_fp8,
+            exclude=exclude,
+            activation_scales=activation_scales,
+        ),
+        install_fp8_linear,
+    )
+
+
+def _bf16_quantiser(model, exclude, activation_scales):
+    # Ampere and newer run bf16 matmuls at full tensor core speed, with no dequantisation.
+    model.to(torch.bfloat16)
+    return None
+
+
+# Each precision level maps to a builder, returning the (quantise, install) pair
+# for a model, or None once it has quantised the model through Quanto itself.
+_PRECISION_TABLE = {
+    "bf16": _bf16_quantiser,
+    "int2-quanto": _grouped_quantiser(2),
+    "int4-quanto": _grouped_quantiser(4),
+    "int8-quanto": _int8_quantiser,
+    "fp8-quanto": _fp8_quantiser,
+}
+_MPS_UNSUPPORTED = {"fp8-quanto"}
+_INTEGER_PRECISIONS = {"int2-quanto", "int4-quanto", "int8-quanto"}
+# Volta and early Turing run integer weights slower than fp16.
+MIN_INTEGER_CAPABILITY = (7, 5)
+_MPS_AVAILABLE = torch.backends.mps.is_available()
+
+
+def _device_supports_precision(model_precision):
+    """
+    Integer weights are slower than fp16 on Volta and early Turing GPUs, so they're refused
+    there, and fp8 warns when it has to fall back to Quanto without native fp8 support.
+    """
+    if not torch.cuda.is_available():
+        return True
+    capability = torch.cuda.get_device_capability()
+    if model_precision in _INTEGER_PRECISIONS and capability < MIN_INTEGER_CAPABILITY:
+        logger.error(
+            f"{model_precision} runs slower than fp16 on GPUs older than compute capability"
+            f" {'.'.join(map(str, MIN_INTEGER_CAPABILITY))}, and this one is {'.'.join(map(str, capability))}."
+            " The model will not be quantised. Use --base_model_precision=no_change instead."
+        )
+        return False
+    if model_precision == "fp8-quanto" and capability < (8, 9):
+        logger.warning(
+            "Native fp8 matmuls need an Ada or Hopper GPU (compute capability 8.9+), fp8-quanto will use Quanto's slower fallback."
+        )
+    return True
+
+
+def _should_quantise(model, model_precision):
+    """
+    Whether the model will be quantised at this precision, logging why when it won't.
+    """
     if model is None:
-        return
+        return False
     if model_precision == "no_change" or model_precision is None:
         logger.info(f"...No quantisation applied to {model.__class__.__name__}.")
+        return False
+    if not _device_supports_precision(model_precision):
+        return False
+    if _is_quantised(model):
+        logger.info(f"...{model.__class__.__name__} is already quantised.")
+        return False
+    linear_parameters = _linear_parameter_count(model)
+    if linear_parameters < MIN_QUANTISATION_PARAMETERS:
+        # Small matrices don't saturate the low-precision kernels, and end up slower.
+        logger.info(
+            f"...Skipping quantisation of {model.__class__.__name__}, it only has {linear_parameters} Linear parameters."
+        )
+        return False
+    if model_precision not in _PRECISION_TABLE:
+        raise ValueError(f"Invalid quantisation level: {model_precision}")
+    if model_precision in _MPS_UNSUPPORTED and _MPS_AVAILABLE:
+        logger.warning(
+            "MPS doesn't support dtype float8_e4m3n, you must select another precision level such as bf16, int2, int8, or int8."
+        )
+        return False
+    return True
+
+
+def _quanto_model(
+    model,
+    model_precision,
+    base_model_precision=None,
+    exclude=None,
+    activation_scales=None,
+    use_cache=True,
+    int8_activations=False,
+):
+    if model_precision is None:
+        model_precision = base_model_precision
+    if not _should_quantise(model, model_precision):
         return
+    _quantise_model(
+        model, model_precision, exclude, activation_scales, use_cache, int8_activations
+    )
+
+
+def _quantise_model(
+    model, model_precision, exclude, activation_scales, use_cache, int8_activations
+):
+    build_quantiser = _PRECISION_TABLE[model_precision]
+    if model_precision == "int8-quanto":
+        build_quantiser = partial(build_quantiser, int_mm=int8_activations)
 
     logger.info(f"Quantising {model.__class__.__name__}. Using {model_precision}.")
-    if model_precision == "int2-quanto":
-        weight_quant = qint2
-    elif model_precision == "int4-quanto":
-        weight_quant = qint4
-    elif model_precision == "int8-quanto":
-        weight_quant = qint8
-    elif model_precision == "fp8-quanto":
-        if torch.backends.mps.is_available():
-            logger.warning(
-                "MPS doesn't support dtype float8_e4m3n, you must select another precision level such as bf16, int2, int8, or int8."
-            )
+    quantiser = build_quantiser(model, exclude, activation_scales)
+    if quantiser is None:
+        return
+    quantise, install = quantiser
 
+    cache_path = None
+    if use_cache:
+        cache_path = quantisation_cache_path(
+            model, model_precision, exclude, "static" if activation_scales else ""
+        )
+    if cache_path is not None and os.path.exists(cache_path):
+        try:
+            restored = load_quantised_linears(model, cache_path, install)
+            logger.info(f"Loaded {restored} quantised Linear layers from {cache_path}.")
             return
-        logger.warning(
-            "An earlier experimental build of this code erroneously used int8 instead of fp8. If you are resuming training and see errors, please use int8 instead of fp8."
+        except Exception as e:
+            logger.warning(f"Could not load quantised weights from {cache_path}: {e}")
+    converted = quantise(model)
+    logger.info(f"Quantised {converted} Linear layers.")
+    if cache_path is not None:
+        try:
+            save_quantised_linears(model, cache_path)
+        except Exception as e:
+            # The model is quantised either way, it just can't be reused by the next run.
+            logger.warning(f"Could not save quantised weights to {cache_path}: {e}")
+
+
+def _model_device(model):
+    parameter = next(model.parameters(), None)
+    return parameter.device if parameter is not None else torch.device("cpu")
+
+
+def _text_encoder_calibration_inputs(model):
+    """
+    Token id batches to calibrate a text encoder's activation scales with: one of padding,
+    as seen for dropped captions, and the rest drawn from the vocabulary.
+    """
+    config = model.config
+    sequence_length = min(getattr(config, "max_position_embeddings", None) or 77, 77)
+    pad_token_id = getattr(config, "pad_token_id", None) or 0
+    device = _model_device(model)
+    generator = torch.Generator().manual_seed(0)
+    batches = [torch.full((1, sequence_length), pad_token_id, dtype=torch.long)]
+    for _ in range(CALIBRATION_BATCHES - 1):
+        batches.append(
+            torch.randint(
+                config.vocab_size,
+                (CALIBRATION_BATCH_SIZE, sequence_length),
+                generator=generator,
+            )
         )
-        weight_quant = qfloat8
-    else:
-        raise ValueError(f"Invalid quantisation level: {args.base_model_precision}")
-    quantize(model, weights=weight_quant)
-    logger.info("Freezing model.")
-    freeze(model)
+    return [batch.to(device) for batch in batches]
+
+
+def _static_fp8_activation_scales(model, model_precision):
+    """
+    Text encoders see a fixed token distribution, so their fp8 activation scales can be
+    calibrated once, rather than measured on every forward pass.
+    """
+    if model_precision != "fp8-quanto" or not supports_native_fp8(_model_device(model)):
+        return None
+    logger.info(f"Calibrating fp8 activation scales for {model.__class__.__name__}.")
+    return calibrate_activation_scales(model, _text_encoder_calibration_inputs(model))
+
+
+def _share_key(model, model_precision):
+    # Text encoders can share a class and checkpoint path while holding different weights,
+    # eg. SD3's two CLIP encoders, so the weights themselves are part of the key.
+    name_or_path = getattr(getattr(model, "config", None), "_name_or_path", None)
+    if not name_or_path or model_precision in (None, "no_change"):
+        return None
+    return model.__class__, name_or_path, weight_fingerprint(model), model_precision
+
+
+def _share_quantised_linears(source, target):
+    """
+    Point the Linear layers of the target at the quantised weights of an identical source
+    model, rather than quantising the same weights a second time.
+    """
+    shared = 0
+    for name, module in source.named_modules():
+        if getattr(module, "weight_scale", None) is None:
+            continue
+        target_module = target.get_submodule(name)
+        target_module.weight = module.weight
+        for buffer in ("weight_scale", "input_scale"):
+            if getattr(module, buffer, None) is not None:
+                target_module.register_buffer(buffer, getattr(module, buffer))
+        for attribute in ("weight_int_mm", "weight_bits"):
+            if hasattr(module, attribute):
+                setattr(target_module, attribute, getattr(module, attribute))
+        target_module.forward = types.MethodType(module.forward.__func__, target_module)
+        shared += 1
+    return shared
+
+
+def _apply_and_consolidate(self, fn, *args, **kwargs):
+    # Module._apply copies each buffer on its own, eg. in .to(device), which would leave the
+    # layers' scales scattered again, so they are gathered back up afterward.
+    result = type(self)._apply(self, fn, *args, **kwargs)
+    _consolidate_scales(self)
+    return result
+
+
+def _consolidate_scales(model):
+    """
+    Gather the scales of the model's quantised layers, which are otherwise many tiny
+    scattered allocations, into one contiguous buffer per dtype and device, leaving each
+    layer's weight_scale as a view into it. The model is re-consolidated whenever it is
+    moved or cast.
+    """
+    for name in [name for name in model._buffers if name.startswith(_SCALES_BUFFER)]:
+        del model._buffers[name]
+    groups = defaultdict(list)
+    for module in model.modules():
+        scale = module._buffers.get("weight_scale")
+        if scale is not None:
+            groups[(scale.dtype, scale.device)].append(module)
+    for index, modules in enumerate(groups.values()):
+        scales = torch.cat([module.weight_scale.reshape(-1) for module in modules])
+        offset = 0
+        for module in modules:
+            shape, numel = module.weight_scale.shape, module.weight_scale.numel()
+            module.register_buffer(
+                "weight_scale", scales[offset : offset + numel].view(shape)
+            )
+            offset += numel
+        model.register_buffer(f"{_SCALES_BUFFER}{index}", scales, persistent=False)
+    if groups and "_apply" not in model.__dict__:
+        model._apply = types.MethodType(_apply_and_consolidate, model)
+    return sum(len(modules) for modules in groups.values())
+
+
+def _quantise_on_cpu(
+    model,
+    model_precision,
+    exclude=None,
+    activation_scales=None,
+    use_cache=True,
+    int8_activations=False,
+):
+    # Only called for models that _should_quantise accepted, so that models which stay as
+    # they are aren't moved back and forth.
+    device = _model_device(model)
+    # Scales are computed on the CPU, rather than with thousands of tiny per-layer
+    # kernel launches on the accelerator, and only the quantised weights go back.
+    model.to("cpu")
+    # Hand the accelerator's cached blocks back before the next model needs them, so peak
+    # memory is the largest model rather than the sum of those still being held.
+    reclaim_memory()
+    _quantise_model(
+        model, model_precision, exclude, activation_scales, use_cache, int8_activations
+    )
+    # Drop the replaced full-precision weights before the quantised ones are uploaded.
+    reclaim_memory()
+    model.to(device)
+    # After the move, since moving a model copies each of its buffers separately.
+    _consolidate_scales(model)
 
 
 def quantoise(unet, transformer, text_encoder_1, text_encoder_2, text_encoder_3, args):
     logger.info("Loading Quanto for LoRA training. This may take a few minutes.")
-    if transformer is not None:
-        _quanto_model(transformer, args.base_model_precision)
-    if unet is not None:
-        _quanto_model(unet, args.base_model_precision)
-    if text_encoder_1 is not None:
-        _quanto_model(
-            text_encoder_1, args.text_encoder_1_precision, args.base_model_precision
+    if (
+        args.base_model_precision == "int8-quanto"
+        and torch.cuda.is_available()
+        and torch.cuda.get_device_capability() >= (8, 0)
+    ):
+        logger.warning(
+            "int8-quanto saves memory at the cost of speed. If the model fits in bf16, --base_model_precision=bf16 trains faster on this GPU."
+        )
+    models = [
+        (transformer, args.base_model_precision, None),
+        (unet, args.base_model_precision, None),
+        (text_encoder_1, args.text_encoder_1_precision, args.base_model_precision),
+        (text_encoder_2, args.text_encoder_2_precision, args.base_model_precision),
+        (text_encoder_3, args.text_encoder_3_precision, args.base_model_precision),
+    ]
+    use_cache = not getattr(args, "disable_quantisation_cache", False)
+    int8_activations = getattr(args, "int8_activation_quantisation", False)
+    jobs = []
+    # Models loaded from the same checkpoint at the same precision are quantised once,
+    # and the rest share the result.
+    sources = {}
+    duplicates = []
+    for model, model_precision, base_model_precision in models:
+        model_precision = model_precision or base_model_precision
+        if not _should_quantise(model, model_precision):
+            continue
+        share_key = _share_key(model, model_precision)
+        exclude = None
+        activation_scales = None
+        if model is transformer or model is unet:
+            # The LoRA targets stay in full precision, so the adapters' base layers
+            # don't need to be dequantised on every forward pass.
+            exclude = _lora_target_names(model, lora_target_modules)
+        elif share_key not in sources:
+            activation_scales = _static_fp8_activation_scales(model, model_precision)
+        job = (
+            model,
+            model_precision,
+            exclude,
+            activation_scales,
+            use_cache,
+            int8_activations,
         )
-    if text_encoder_2 is not None:
-        _quanto_model(
-            text_encoder_2, args.text_encoder_2_precision, args.base_model_precision
+        if share_key in sources:
+            duplicates.append((sources[share_key], job))
+            continue
+        if share_key is not None:
+            sources[share_key] = model
+        jobs.append(job)
+    # The tensor operations release the GIL, so the text encoders are quantised
+    # while the diffusion model is.
+    with ThreadPoolExecutor(max_workers=QUANTISATION_WORKERS) as executor:
+        for future in [executor.submit(_quantise_on_cpu, *job) for job in jobs]:
+            future.result()
+    warmup_steps = getattr(args, "fp8_activation_warmup_steps", 0)
+    if (
+        warmup_steps
+        and transformer is not None
+        and torch.cuda.is_available()
+        and torch.cuda.get_device_capability() >= (9, 0)
+    ):
+        # Hopper: settle on static activation scales for the transformer's fp8 layers.
+        enabled = enable_delayed_scaling(transformer, warmup_steps)
+        logger.info(
+            f"Using delayed fp8 activation scaling for {enabled} transformer layers."
         )
-    if text_encoder_3 is not None:
-        _quanto_model(
-            text_encoder_3, args.text_encoder_3_precision, args.base_model_precision
+    for source, job in duplicates:
+        model = job[0]
+        if model is source:
+            continue
+        shared = _share_quantised_linears(source, model)
+        if not shared:
+            # Quanto's own modules and plain casts can't be shared this way.
+            _quantise_on_cpu(*job)
+            continue
+        logger.info(
+            f"Shared {shared} quantised Linear layers of {source.__class__.__name__} with its duplicate."
         )
+        reclaim_memory()
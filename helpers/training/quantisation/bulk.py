@@ -0,0 +1,147 @@
+import types
+from collections import defaultdict
+import torch
+import torch.nn.functional as F
+from helpers.training.quantisation.compile import compiled_on_cuda
+
+# Upper bound on the number of weight elements quantised in one batch, to cap the
+# temporary float32 copy made while computing the scales.
+BULK_QUANTISATION_CHUNK = 1 << 28
+# torch._int_mm only has an accelerated kernel for more than 16 rows, and
+# inner/output dimensions that are multiples of 8.
+INT_MM_MIN_ROWS = 16
+INT_MM_ALIGNMENT = 8
+
+
+def int_mm_supported(rows: int, in_features: int, out_features: int) -> bool:
+    return (
+        hasattr(torch, "_int_mm")
+        and rows > INT_MM_MIN_ROWS
+        and in_features % INT_MM_ALIGNMENT == 0
+        and out_features % INT_MM_ALIGNMENT == 0
+    )
+
+
+class _Int8Matmul(torch.autograd.Function):
+    """
+    x @ weight.T with int8 activations, quantised per row on the fly. The weight is frozen, but
+    LoRA adapters further up the graph still need the gradient with respect to the input.
+    """
+
+    @staticmethod
+    def forward(ctx, x, weight, weight_scale):
+        x_scale = x.detach().abs().amax(dim=-1, keepdim=True).float().clamp(min=1e-12)
+        x_scale = x_scale / 127
+        x_int8 = (x.detach().float() / x_scale).round_().clamp_(-127, 127)
+        output = torch._int_mm(x_int8.to(torch.int8), weight.t())
+        ctx.save_for_backward(weight, weight_scale)
+        return (output.float() * x_scale * weight_scale.t()).to(x.dtype)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        weight, weight_scale = ctx.saved_tensors
+        weight = weight.to(grad_output.dtype) * weight_scale.to(grad_output.dtype)
+        return grad_output @ weight, None, None
+
+
+@compiled_on_cuda
+def _int8_weight_only_linear(input, weight, weight_scale, bias):
+    weight = weight.to(input.dtype) * weight_scale.to(input.dtype)
+    bias = bias.to(input.dtype) if bias is not None else None
+    return F.linear(input, weight, bias)
+
+
+def _int8_linear_forward(self, input: torch.Tensor) -> torch.Tensor:
+    rows = input.numel() // self.in_features
+    if self.weight_int_mm and int_mm_supported(
+        rows, self.in_features, self.out_features
+    ):
+        output = _Int8Matmul.apply(
+            input.reshape(rows, self.in_features), self.weight, self.weight_scale
+        ).reshape(*input.shape[:-1], self.out_features)
+        if self.bias is not None:
+            output = output + self.bias.to(input.dtype)
+        return output
+    # Weight-only: the activations stay in their own precision.
+    return _int8_weight_only_linear(input, self.weight, self.weight_scale, self.bias)
+
+
+def install_int8_linear(
+    module: torch.nn.Linear, weight, scale, int_mm: bool = False
+) -> None:
+    """
+    Replace the weight of an nn.Linear with an already-quantised int8 one.
+    """
+    module.weight = torch.nn.Parameter(weight, requires_grad=False)
+    module.register_buffer("weight_scale", scale)
+    module.weight_int_mm = int_mm
+    module.forward = types.MethodType(_int8_linear_forward, module)
+
+
+def _absmax(tensor: torch.Tensor) -> torch.Tensor:
+    # The max-norm gives the row-wise abs().amax() without an abs() copy of the tensor.
+    return torch.linalg.vector_norm(tensor, float("inf"), dim=-1, keepdim=True)
+
+
+def _batches(modules):
+    batch, numel = [], 0
+    for module in modules:
+        if batch and numel + module.weight.numel() > BULK_QUANTISATION_CHUNK:
+            yield batch
+            batch, numel = [], 0
+        batch.append(module)
+        numel += module.weight.numel()
+    if batch:
+        yield batch
+
+
+@torch.no_grad()
+def bulk_quantise_linears(
+    model: torch.nn.Module, int_mm: bool = False, exclude: set = None
+) -> int:
+    """
+    Quantise the weight of every nn.Linear in the model to int8, with one symmetric scale per
+    output row.
+
+    Rather than quantising one layer at a time, the weights of layers sharing an input size are
+    concatenated row-wise, so that the scales and the rounding are computed for many layers at
+    once. The modules keep their nn.Linear class so that LoRA adapters can still target them.
+    Modules named in `exclude` are left untouched.
+
+    With `int_mm`, activations are also quantised to int8 and multiplied with torch._int_mm,
+    for the inputs that its accelerated kernel accepts. Other inputs stay weight-only.
+
+    Returns:
+        int: The number of layers that were converted.
+    """
+    by_in_features = defaultdict(list)
+    for name, module in model.named_modules():
+        if name in (exclude or ()):
+            continue
+        if isinstance(module, torch.nn.Linear) and module.weight.is_floating_point():
+            by_in_features[module.in_features].append(module)
+
+    converted = 0
+    for modules in by_in_features.values():
+        for batch in _batches(modules):
+            rows = [module.out_features for module in batch]
+            # One float32 buffer for the batch, quantised in place, so the peak is a
+            # single copy of the batch on top of the weights being replaced.
+            weights = torch.empty(
+                sum(rows),
+                batch[0].in_features,
+                dtype=torch.float32,
+                device=batch[0].weight.device,
+            )
+            for module, weight in zip(batch, weights.split(rows)):
+                weight.copy_(module.weight)
+            scales = _absmax(weights).clamp_(min=1e-12) / 127
+            quantised = weights.div_(scales).round_().clamp_(-127, 127).to(torch.int8)
+            for module, weight, scale in zip(
+                batch, quantised.split(rows), scales.split(rows)
+            ):
+                # Cloned, so that the batch's storage is released once it's done.
+                install_int8_linear(module, weight.clone(), scale.clone(), int_mm)
+            converted += len(batch)
+            del weights, quantised
+    return converted
@@ -0,0 +1,113 @@
+import hashlib
+import os
+import tempfile
+import torch
+from safetensors.torch import load_file, save_file
+
+# Bumped whenever the layout of the stored quantised weights changes.
+QUANTISATION_CACHE_VERSION = 2
+QUANTISATION_CACHE_DIR = os.environ.get(
+    "SIMPLETUNER_QUANTISATION_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "simpletuner", "quantisation"),
+)
+# Values sampled from each Linear weight for the cache key's fingerprint.
+FINGERPRINT_SAMPLES = 4096
+
+
+@torch.no_grad()
+def weight_fingerprint(model) -> str:
+    """
+    A digest of the model's Linear weights, from their names, shapes and an evenly strided
+    sample of their values, so that a checkpoint whose contents change under the same path
+    (eg. a fine-tune or merge saved over it) doesn't reuse the old quantised weights.
+    """
+    digest = hashlib.sha256()
+    for name, module in model.named_modules():
+        if not isinstance(module, torch.nn.Linear):
+            continue
+        weight = module.weight.detach().reshape(-1)
+        stride = max(1, weight.numel() // FINGERPRINT_SAMPLES)
+        digest.update(f"{name}:{tuple(module.weight.shape)}".encode())
+        digest.update(weight[::stride].to(torch.float32).cpu().numpy().tobytes())
+    return digest.hexdigest()
+
+
+def quantisation_cache_path(
+    model, model_precision: str, exclude=None, variant: str = ""
+) -> str:
+    """
+    Where the quantised weights of a model are kept between runs, or None if the model
+    doesn't say which checkpoint it was loaded from. The key includes a fingerprint of the
+    weights themselves, which must still be in their original precision.
+    """
+    name_or_path = getattr(getattr(model, "config", None), "_name_or_path", None)
+    if not name_or_path:
+        return None
+    key = ":".join(
+        [
+            str(QUANTISATION_CACHE_VERSION),
+            model.__class__.__name__,
+            str(name_or_path),
+            weight_fingerprint(model),
+            model_precision,
+            torch.__version__,
+            ",".join(sorted(exclude or ())),
+            variant,
+        ]
+    )
+    digest = hashlib.sha256(key.encode()).hexdigest()
+    return os.path.join(QUANTISATION_CACHE_DIR, f"{digest}.safetensors")
+
+
+def save_quantised_linears(model, path: str) -> None:
+    """
+    Store the weights and scales of the model's quantised Linear layers.
+    """
+    state_dict = {}
+    for name, module in model.named_modules():
+        scale = getattr(module, "weight_scale", None)
+        if scale is None:
+            continue
+        state_dict[f"{name}.weight"] = module.weight.detach().cpu().contiguous()
+        state_dict[f"{name}.weight_scale"] = scale.detach().cpu().contiguous()
+        input_scale = getattr(module, "input_scale", None)
+        if input_scale is not None:
+            state_dict[f"{name}.input_scale"] = input_scale.detach().cpu().contiguous()
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    # Written to a uniquely named file and renamed, so an interrupted run can't leave a
+    # partial file behind, and ranks writing the same model at once don't share one.
+    with tempfile.NamedTemporaryFile(
+        dir=directory, suffix=".tmp", delete=False
+    ) as temporary:
+        temporary_path = temporary.name
+    try:
+        save_file(state_dict, temporary_path)
+        os.replace(temporary_path, path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+
+def load_quantised_linears(model, path: str, install) -> int:
+    """
+    Restore quantised Linear layers stored by save_quantised_linears.
+
+    Args:
+        install (callable): Called with the module, its quantised weight and its scale.
+    Returns:
+        int: The number of layers that were restored.
+    """
+    state_dict = load_file(path)
+    restored = 0
+    for key, scale in state_dict.items():
+        if not key.endswith(".weight_scale"):
+            continue
+        name = key[: -len(".weight_scale")]
+        module = model.get_submodule(name)
+        install(module, state_dict[f"{name}.weight"], scale)
+        if f"{name}.input_scale" in state_dict:
+            module.register_buffer("input_scale", state_dict[f"{name}.input_scale"])
+        restored += 1
+    return restored
@@ -0,0 +1,24 @@
+import os
+import torch
+
+# Set SIMPLETUNER_COMPILE_QUANT=0 to run the dequantising Linear kernels eagerly.
+COMPILE_QUANTISED_LINEARS = os.environ.get("SIMPLETUNER_COMPILE_QUANT", "1") == "1"
+
+
+def compiled_on_cuda(fn):
+    """
+    Wrap a functional Linear kernel, so that CUDA inputs go through a torch.compile'd copy that
+    fuses the dequantisation, and other devices keep running it eagerly.
+
+    The kernel is compiled once for all layers, with dynamic shapes, rather than per module.
+    """
+    if not COMPILE_QUANTISED_LINEARS or not hasattr(torch, "compile"):
+        return fn
+    compiled = torch.compile(fn, dynamic=True)
+
+    def dispatch(input, *args):
+        if input.is_cuda:
+            return compiled(input, *args)
+        return fn(input, *args)
+
+    return dispatch
@@ -0,0 +1,222 @@
+import types
+import torch
+import torch.nn.functional as F
+
+E4M3_MAX = 448.0
+# Weight of the previous value in the running activation scale of delayed scaling.
+DELAYED_SCALING_MOMENTUM = 0.9
+# torch._scaled_mm needs the inner and output dimensions to be multiples of 16.
+SCALED_MM_ALIGNMENT = 16
+# Calibrated activation scales cover this multiple of the largest input seen, as real
+# prompts can produce larger activations than the calibration batches.
+CALIBRATION_HEADROOM = 2.0
+
+
+def supports_native_fp8(device=None) -> bool:
+    """
+    Whether the CUDA device has FP8 tensor cores (Ada / Hopper, SM89+) usable via torch._scaled_mm.
+    """
+    if not torch.cuda.is_available() or not hasattr(torch, "_scaled_mm"):
+        return False
+    if device is not None and torch.device(device).type != "cuda":
+        device = None
+    return torch.cuda.get_device_capability(device) >= (8, 9)
+
+
+def quantise_to_fp8(tensor: torch.Tensor):
+    """
+    Quantise a tensor to float8_e4m3fn with a single per-tensor scale.
+
+    Returns:
+        tuple: The fp8 tensor and its float32 scale, such that tensor ~= fp8 * scale.
+    """
+    absmax = torch.linalg.vector_norm(tensor.detach(), float("inf"))
+    scale = absmax.float().clamp(min=1e-12) / E4M3_MAX
+    return cast_to_fp8(tensor, scale), scale
+
+
+def cast_to_fp8(tensor: torch.Tensor, scale: torch.Tensor) -> torch.Tensor:
+    """
+    Cast a tensor to float8_e4m3fn with a known scale, saturating values out of range.
+    """
+    return (
+        tensor.detach()
+        .to(torch.float32, copy=True)
+        .div_(scale)
+        .clamp_(-E4M3_MAX, E4M3_MAX)
+        .to(torch.float8_e4m3fn)
+    )
+
+
+class _ScaledMatmul(torch.autograd.Function):
+    """
+    x @ weight.T on the FP8 tensor cores. The weight is frozen, but LoRA adapters further up
+    the graph still need the gradient with respect to the input, so backward provides it.
+    """
+
+    @staticmethod
+    def forward(ctx, x, weight_fp8, weight_scale, bias, input_scale=None):
+        if input_scale is None:
+            x_fp8, x_scale = quantise_to_fp8(x)
+        else:
+            # A calibrated or running scale saves reducing over the input on every call.
+            x_fp8, x_scale = cast_to_fp8(x, input_scale), input_scale
+        output = torch._scaled_mm(
+            x_fp8,
+            weight_fp8.t(),
+            scale_a=x_scale,
+            scale_b=weight_scale,
+            bias=bias,
+            out_dtype=x.dtype,
+        )
+        if isinstance(output, tuple):
+            # Older torch releases also return the amax.
+            output = output[0]
+        ctx.save_for_backward(weight_fp8, weight_scale)
+        return output
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        weight_fp8, weight_scale = ctx.saved_tensors
+        weight = weight_fp8.to(grad_output.dtype) * weight_scale.to(grad_output.dtype)
+        return grad_output @ weight, None, None, None, None
+
+
+@torch.no_grad()
+def _update_running_input_scale(module, input: torch.Tensor) -> None:
+    absmax = torch.linalg.vector_norm(input.detach(), float("inf")).float()
+    scale = absmax.clamp(min=1e-12) / E4M3_MAX
+    if getattr(module, "input_scale", None) is None:
+        module.register_buffer("input_scale", scale)
+    else:
+        module.input_scale.mul_(DELAYED_SCALING_MOMENTUM).add_(
+            scale * (1 - DELAYED_SCALING_MOMENTUM)
+        )
+    module.input_scale_warmup -= 1
+
+
+def _fp8_linear_forward(self, input: torch.Tensor) -> torch.Tensor:
+    bias = self.bias.to(input.dtype) if self.bias is not None else None
+    if (
+        self.in_features % SCALED_MM_ALIGNMENT
+        or self.out_features % SCALED_MM_ALIGNMENT
+    ):
+        weight = self.weight.to(input.dtype) * self.weight_scale.to(input.dtype)
+        return F.linear(input, weight, bias)
+    input_scale = getattr(self, "input_scale", None)
+    if getattr(self, "input_scale_warmup", 0) > 0:
+        _update_running_input_scale(self, input)
+        # Scaled dynamically until the running scale has settled.
+        input_scale = None
+    output = _ScaledMatmul.apply(
+        input.reshape(-1, self.in_features).contiguous(),
+        self.weight,
+        self.weight_scale,
+        bias,
+        input_scale,
+    )
+    return output.reshape(*input.shape[:-1], self.out_features)
+
+
+def install_fp8_linear(
+    module: torch.nn.Linear, weight_fp8, scale, input_scale=None
+) -> None:
+    """
+    Replace the weight of an nn.Linear with an already-quantised float8_e4m3fn one.
+    """
+    module.weight = torch.nn.Parameter(weight_fp8, requires_grad=False)
+    module.register_buffer("weight_scale", scale)
+    if input_scale is not None:
+        module.register_buffer("input_scale", input_scale)
+    module.forward = types.MethodType(_fp8_linear_forward, module)
+
+
+def enable_delayed_scaling(model: torch.nn.Module, warmup_steps: int) -> int:
+    """
+    Have the model's fp8 layers without a calibrated input scale keep a running average of
+    their activation scale over their first `warmup_steps` forward passes, and cast with that
+    static scale as it is from then on, instead of reducing over the activations on every
+    call. Activations beyond it saturate at the largest fp8 value.
+
+    Returns:
+        int: The number of layers that will use delayed scaling.
+    """
+    enabled = 0
+    for module in model.modules():
+        if (
+            isinstance(module, torch.nn.Linear)
+            and module.weight.dtype == torch.float8_e4m3fn
+            and getattr(module, "input_scale", None) is None
+        ):
+            module.input_scale_warmup = warmup_steps
+            enabled += 1
+    return enabled
+
+
+@torch.no_grad()
+def calibrate_activation_scales(model: torch.nn.Module, inputs) -> dict:
+    """
+    Run the model over some calibration inputs, and record the static fp8 scale of the
+    input to each of its nn.Linear layers, with CALIBRATION_HEADROOM over the largest value
+    seen. Inputs that still exceed it saturate at the largest fp8 value.
+
+    Returns:
+        dict: The float32 scale of each layer, by module name.
+    """
+    absmax = {}
+
+    def record(name):
+        def hook(module, args):
+            value = torch.linalg.vector_norm(args[0].detach(), float("inf")).float()
+            absmax[name] = (
+                torch.maximum(absmax[name], value) if name in absmax else value
+            )
+
+        return hook
+
+    hooks = [
+        module.register_forward_pre_hook(record(name))
+        for name, module in model.named_modules()
+        if isinstance(module, torch.nn.Linear)
+    ]
+    try:
+        for batch in inputs:
+            model(batch)
+    finally:
+        for hook in hooks:
+            hook.remove()
+    return {
+        name: (value.clamp(min=1e-12) * CALIBRATION_HEADROOM / E4M3_MAX).cpu()
+        for name, value in absmax.items()
+    }
+
+
+@torch.no_grad()
+def quantise_linears_to_fp8(
+    model: torch.nn.Module, exclude: set = None, activation_scales: dict = None
+) -> int:
+    """
+    Store the weight of every nn.Linear in the model as float8_e4m3fn, with a per-tensor
+    scale buffer, and run their forward pass through torch._scaled_mm.
+
+    The modules keep their nn.Linear class so that LoRA adapters can still target them.
+    Modules named in `exclude` are left untouched. Layers with an entry in
+    `activation_scales`, from calibrate_activation_scales, cast their inputs with that static
+    scale instead of measuring it on every call.
+
+    Returns:
+        int: The number of layers that were converted.
+    """
+    converted = 0
+    for name, module in model.named_modules():
+        if not isinstance(module, torch.nn.Linear) or name in (exclude or ()):
+            continue
+        if module.weight.dtype == torch.float8_e4m3fn:
+            continue
+        install_fp8_linear(
+            module,
+            *quantise_to_fp8(module.weight),
+            input_scale=(activation_scales or {}).get(name),
+        )
+        converted += 1
+    return converted
@@ -0,0 +1,149 @@
+import types
+import torch
+import torch.nn.functional as F
+from helpers.training.quantisation.compile import compiled_on_cuda
+
+DEFAULT_GROUP_SIZE = 128
+# Fractions of each group's range tried as its clipping range.
+CLIP_RATIOS = tuple(1.0 - 0.05 * step for step in range(11))
+FLOAT16_TINY = torch.finfo(torch.float16).tiny
+
+
+def pack_weight(quantised: torch.Tensor, bits: int) -> torch.Tensor:
+    """
+    Pack unsigned values of the given bit width into uint8, lowest bits first,
+    eg. (hi << 4) | lo for int4.
+    """
+    per_byte = 8 // bits
+    quantised = quantised.to(torch.uint8).reshape(*quantised.shape[:-1], -1, per_byte)
+    packed = torch.zeros(
+        quantised.shape[:-1], dtype=torch.uint8, device=quantised.device
+    )
+    for idx in range(per_byte):
+        packed |= quantised[..., idx] << (bits * idx)
+    return packed
+
+
+def unpack_weight(packed: torch.Tensor, bits: int) -> torch.Tensor:
+    per_byte = 8 // bits
+    mask = (1 << bits) - 1
+    unpacked = torch.stack(
+        [(packed >> (bits * idx)) & mask for idx in range(per_byte)], dim=-1
+    )
+    return unpacked.reshape(*packed.shape[:-1], -1)
+
+
+def _group_error(grouped, scale, offset, qmax):
+    quantised = grouped.sub(offset).div_(scale).round_().clamp_(0, qmax)
+    return quantised.mul_(scale).add_(offset).sub_(grouped).square_().sum(-1, True)
+
+
+def group_quantise(weight: torch.Tensor, bits: int, group_size: int):
+    """
+    Affine quantisation with one scale and offset per group of `group_size` input columns,
+    using every level of the bit width. Each group is clipped to whichever of CLIP_RATIOS of
+    its range gives the lowest squared error, as clipping a few outliers usually pays for
+    itself, most of all at 2 bits.
+
+    Returns:
+        tuple: The packed uint8 weight of shape [O, I * bits / 8], and the float16 scales and
+        offsets of shape [O, I / group_size, 2].
+    """
+    qmax = 2**bits - 1
+    out_features, in_features = weight.shape
+    grouped = weight.detach().to(torch.float32, copy=True)
+    grouped = grouped.reshape(out_features, -1, group_size)
+    low = grouped.amin(dim=-1, keepdim=True)
+    span = grouped.amax(dim=-1, keepdim=True).sub_(low)
+    best = None
+    for ratio in CLIP_RATIOS:
+        # Rounded through float16 first, so the search sees the values that are stored.
+        scale = (span * (ratio / qmax)).clamp_(min=FLOAT16_TINY).half().float()
+        offset = (low * ratio).half().float()
+        error = _group_error(grouped, scale, offset, qmax)
+        if best is None:
+            best = error, scale, offset
+            continue
+        better = error < best[0]
+        best = tuple(
+            torch.where(better, value, best_value)
+            for value, best_value in zip((error, scale, offset), best)
+        )
+    _, scale, offset = best
+    # Quantised in place, so only one float32 copy of the layer exists at a time.
+    quantised = grouped.sub_(offset).div_(scale).round_().clamp_(0, qmax)
+    return (
+        pack_weight(quantised.reshape(out_features, in_features), bits),
+        torch.cat([scale, offset], dim=-1).to(torch.float16),
+    )
+
+
+def group_dequantise(packed, scales, bits: int, dtype=torch.float32):
+    out_features, groups = scales.shape[:2]
+    quantised = unpack_weight(packed, bits).reshape(out_features, groups, -1)
+    scales = scales.to(dtype)
+    weight = quantised.to(dtype) * scales[..., :1] + scales[..., 1:]
+    return weight.reshape(out_features, -1)
+
+
+@compiled_on_cuda
+def _grouped_linear(input, packed, scales, bits, bias):
+    weight = group_dequantise(packed, scales, bits, dtype=input.dtype)
+    bias = bias.to(input.dtype) if bias is not None else None
+    return F.linear(input, weight, bias)
+
+
+def _grouped_linear_forward(self, input: torch.Tensor) -> torch.Tensor:
+    return _grouped_linear(
+        input, self.weight, self.weight_scale, self.weight_bits, self.bias
+    )
+
+
+def install_grouped_linear(module: torch.nn.Linear, packed, scales, bits: int):
+    """
+    Replace the weight of an nn.Linear with an already-quantised, packed one.
+    """
+    module.weight = torch.nn.Parameter(packed, requires_grad=False)
+    module.register_buffer("weight_scale", scales)
+    module.weight_bits = bits
+    module.forward = types.MethodType(_grouped_linear_forward, module)
+
+
+@torch.no_grad()
+def group_quantise_linears(
+    model: torch.nn.Module,
+    bits: int,
+    group_size: int = DEFAULT_GROUP_SIZE,
+    exclude: set = None,
+) -> int:
+    """
+    Quantise the weight of every nn.Linear in the model to `bits` (4 or 2), with one scale and
+    offset per group of input columns, and pack the result into uint8.
+
+    Layers whose input size isn't a multiple of the group size use a single group per row.
+    The modules keep their nn.Linear class so that LoRA adapters can still target them.
+    Modules named in `exclude` are left untouched.
+
+    Returns:
+        int: The number of layers that were converted.
+    """
+    if bits not in (2, 4):
+        raise ValueError(f"Group-wise quantisation supports 2 or 4 bits, not {bits}.")
+    converted = 0
+    for name, module in model.named_modules():
+        if (
+            not isinstance(module, torch.nn.Linear)
+            or not module.weight.is_floating_point()
+            or name in (exclude or ())
+        ):
+            continue
+        layer_group_size = group_size
+        if module.in_features % group_size:
+            layer_group_size = module.in_features
+        if layer_group_size % (8 // bits):
+            # The row can't be packed into whole bytes.
+            continue
+        packed, scales = group_quantise(module.weight, bits, layer_group_size)
+        install_grouped_linear(module, packed, scales, bits)
+        converted += 1
+    return converted
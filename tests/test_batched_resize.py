@@ -0,0 +1,113 @@
+import unittest
+from unittest.mock import MagicMock, patch
+
+import torch
+from PIL import Image
+
+from helpers.caching.vae import VAECache
+from helpers.image_manipulation.batched_resize import BatchedResizer
+from helpers.image_manipulation.training_sample import TrainingSample
+from helpers.training.state_tracker import StateTracker
+
+
+class TestBatchedResizer(unittest.TestCase):
+    def setUp(self):
+        self.resizer = BatchedResizer(device="cpu")
+
+    def test_resize_keeps_order_and_sizes(self):
+        images = [
+            Image.new("RGB", (64, 48), "red"),
+            Image.new("RGB", (32, 32), "green"),
+            Image.new("RGB", (64, 48), "blue"),
+        ]
+        sizes = [(32, 24), (16, 16), (32, 24)]
+        results = self.resizer.resize(images, sizes)
+        self.assertEqual([image.size for image in results], sizes)
+        self.assertEqual(results[0].getpixel((8, 8)), (255, 0, 0))
+        self.assertEqual(results[1].getpixel((8, 8)), (0, 128, 0))
+        self.assertEqual(results[2].getpixel((8, 8)), (0, 0, 255))
+
+    def test_resize_skips_images_already_at_size(self):
+        image = Image.new("RGB", (32, 32), "white")
+        self.assertIs(self.resizer.resize([image], [(32, 32)])[0], image)
+
+    def test_resize_rejects_mismatched_lengths(self):
+        with self.assertRaises(ValueError):
+            self.resizer.resize([Image.new("RGB", (8, 8))], [])
+
+    @patch.object(
+        StateTracker,
+        "get_data_backend_config",
+        return_value={"crop": False, "resolution": 512, "resolution_type": "pixel"},
+    )
+    @patch.object(
+        StateTracker,
+        "get_args",
+        return_value=MagicMock(aspect_bucket_alignment=8, aspect_bucket_rounding=2),
+    )
+    def test_resize_samples_applies_intermediary_size(self, *_):
+        metadata = {
+            "original_size": (1024, 768),
+            "intermediary_size": (683, 512),
+            "target_size": (680, 512),
+            "crop_coordinates": (0, 0),
+            "aspect_ratio": 1.33,
+        }
+        sample = TrainingSample(
+            Image.new("RGB", (1024, 768), "white"), "test_backend", metadata
+        )
+        self.resizer.resize_samples([sample])
+        self.assertEqual(sample.image.size, (683, 512))
+        sample.prepare()
+        self.assertEqual(sample.image.size, (680, 512))
+
+
+class TestVAECacheBatchedResize(unittest.TestCase):
+    @patch.object(
+        StateTracker,
+        "get_data_backend_config",
+        return_value={"crop": False, "resolution": 512, "resolution_type": "pixel"},
+    )
+    @patch.object(
+        StateTracker,
+        "get_args",
+        return_value=MagicMock(aspect_bucket_alignment=8, aspect_bucket_rounding=2),
+    )
+    def test_process_images_resizes_as_one_batch(self, *_):
+        metadata = {
+            "original_size": (1024, 768),
+            "intermediary_size": (683, 512),
+            "target_size": (680, 512),
+            "crop_coordinates": (0, 0),
+            "aspect_ratio": 1.33,
+        }
+        vae_cache = VAECache.__new__(VAECache)
+        vae_cache.id = "test_backend"
+        vae_cache.batched_resizer = BatchedResizer(device="cpu")
+        vae_cache.max_workers = 2
+        vae_cache.minimum_image_size = None
+        vae_cache.metadata_backend = MagicMock()
+        vae_cache.accelerator = MagicMock(device="cpu")
+        vae_cache.vae = MagicMock(dtype=torch.float32)
+        vae_cache.rank_info = ""
+        paths = ["a.png", "b.png"]
+        with patch(
+            "helpers.caching.vae.load_training_sample",
+            side_effect=lambda data_backend_id, filepath: TrainingSample(
+                Image.new("RGB", (1024, 768), "white"), data_backend_id, metadata
+            ),
+        ), patch.object(
+            BatchedResizer, "resize", wraps=vae_cache.batched_resizer.resize
+        ) as resize:
+            outputs = vae_cache._process_images_in_batch(
+                image_paths=list(paths), image_data=[None, None], disable_queue=True
+            )
+        resize.assert_called_once()
+        self.assertEqual(len(resize.call_args.args[0]), 2)
+        self.assertEqual(
+            [tuple(output[0].shape) for output in outputs], [(3, 512, 680)] * 2
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+import importlib.util
+import json
+import unittest
+
+import numpy as np
+from PIL import Image
+
+from helpers.image_manipulation import brightness
+from helpers.image_manipulation.brightness import calculate_luminance
+
+
+class TestCalculateLuminance(unittest.TestCase):
+    def test_matches_bt601_luma(self):
+        rng = np.random.default_rng(0)
+        pixels = rng.integers(0, 256, size=(64, 48, 3), dtype=np.uint8)
+        expected = (
+            0.299 * pixels[..., 0] + 0.587 * pixels[..., 1] + 0.114 * pixels[..., 2]
+        ).mean()
+        luminance = calculate_luminance(Image.fromarray(pixels))
+        self.assertAlmostEqual(luminance, expected, delta=0.5)
+
+    def test_solid_colours(self):
+        self.assertAlmostEqual(
+            calculate_luminance(Image.new("RGB", (8, 8), "white")), 255, delta=0.5
+        )
+        self.assertAlmostEqual(
+            calculate_luminance(Image.new("RGB", (8, 8), "black")), 0, delta=0.5
+        )
+        self.assertAlmostEqual(
+            calculate_luminance(Image.new("RGB", (8, 8), (255, 0, 0))),
+            0.299 * 255,
+            delta=0.5,
+        )
+
+    def test_result_is_json_serialisable(self):
+        luminance = calculate_luminance(Image.new("L", (8, 8), 128))
+        self.assertEqual(json.loads(json.dumps(luminance)), luminance)
+
+
+@unittest.skipIf(importlib.util.find_spec("numba") is None, "numba is not installed")
+class TestLumaKernel(unittest.TestCase):
+    def test_matches_pil_luma(self):
+        rng = np.random.default_rng(0)
+        img = Image.fromarray(rng.integers(0, 256, size=(64, 48, 3), dtype=np.uint8))
+        expected = np.asarray(img.convert("L"), dtype=np.float64).mean()
+        luminance = brightness._luma_kernel(np.asarray(img).reshape(-1, 3))
+        self.assertAlmostEqual(luminance, expected, delta=0.5)
+        self.assertEqual(calculate_luminance(img), luminance)
+
+
+if __name__ == "__main__":
+    unittest.main()
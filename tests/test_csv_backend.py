@@ -0,0 +1,347 @@
+import functools
+import os
+import tempfile
+import threading
+import time
+import unittest
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from unittest.mock import Mock, patch
+
+import torch
+from PIL import Image
+
+from helpers.data_backend.csv import CSVDataBackend, html_to_file_loc
+
+
+class TestCSVDataBackend(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.csv_file = Path(self.temp_dir.name) / "data.csv"
+        with open(self.csv_file, "w") as f:
+            f.write("url,caption\n")
+            f.write("http://example.com/a.png,first a\n")
+            f.write("http://example.com/b.png,only b\n")
+            f.write("http://example.com/a.png,second a\n")
+        self.backend = CSVDataBackend(
+            accelerator=Mock(),
+            id="foo",
+            csv_file=self.csv_file,
+            image_cache_loc=self.temp_dir.name,
+        )
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_deduplicates_keeping_last(self):
+        self.assertEqual(len(self.backend.df), 2)
+        self.assertEqual(
+            self.backend.get_caption("http://example.com/a.png"), "second a"
+        )
+        self.assertEqual(self.backend.get_caption("http://example.com/b.png"), "only b")
+
+    def test_cached_locs_match_html_to_file_loc(self):
+        urls = [
+            "http://example.com/a.png",
+            "https://example.com/dir/with%20space%20and more.jpg",
+            "https://example.com/" + "x" * 300 + ".png",
+        ]
+        with open(self.csv_file, "w") as f:
+            f.write("url,caption\n")
+            for url in urls:
+                f.write(f"{url},caption\n")
+        for shorten_filenames in [False, True]:
+            backend = CSVDataBackend(
+                accelerator=Mock(),
+                id="foo",
+                csv_file=self.csv_file,
+                image_cache_loc=self.temp_dir.name,
+                shorten_filenames=shorten_filenames,
+            )
+            self.assertEqual(
+                backend._cached_locs,
+                {
+                    url: html_to_file_loc(
+                        Path(self.temp_dir.name), url, shorten_filenames
+                    )
+                    for url in urls
+                },
+            )
+
+    def test_exists(self):
+        self.assertTrue(self.backend.exists("http://example.com/a.png"))
+        self.assertFalse(self.backend.exists("http://example.com/missing.png"))
+        self.assertFalse(
+            self.backend.exists(os.path.join(self.temp_dir.name, "missing.png"))
+        )
+
+    def test_delete(self):
+        local_png = os.path.join(self.temp_dir.name, "local.png")
+        Image.new("RGB", (8, 8)).save(local_png)
+        self.backend.torch_save(torch.zeros(2), local_png)
+        self.assertTrue(self.backend.exists(local_png))
+        self.backend.delete(local_png)
+        self.backend.delete("http://example.com/a.png")
+        self.assertFalse(self.backend.exists(local_png))
+        self.assertFalse(os.path.exists(local_png))
+        self.assertFalse(self.backend.exists("http://example.com/a.png"))
+        self.assertEqual(
+            self.backend.list_files("*.png", instance_data_dir=self.temp_dir.name),
+            [("", [], {"http://example.com/b.png"})],
+        )
+        self.backend.save_state()
+        self.assertEqual(list(self.backend.df.index), ["http://example.com/b.png"])
+
+    def test_list_files(self):
+        local_png = os.path.join(self.temp_dir.name, "local.png")
+        Image.new("RGB", (8, 8)).save(local_png)
+        missing_png = os.path.join(self.temp_dir.name, "missing.png")
+        with open(self.csv_file, "a") as f:
+            f.write(f"{local_png},local\n")
+            f.write(f"{missing_png},missing\n")
+        backend = CSVDataBackend(accelerator=Mock(), id="foo", csv_file=self.csv_file)
+        results = backend.list_files("*.png", instance_data_dir=self.temp_dir.name)
+        self.assertEqual(results[0], ("/", [], [local_png]))
+        self.assertEqual(
+            results[1],
+            (
+                "",
+                [],
+                {
+                    "http://example.com/a.png",
+                    "http://example.com/b.png",
+                    missing_png,
+                },
+            ),
+        )
+        self.assertEqual(
+            backend.list_files("*b.png", instance_data_dir=self.temp_dir.name),
+            [("", [], {"http://example.com/b.png"})],
+        )
+
+    def test_list_files_multiple_wildcards(self):
+        with open(self.csv_file, "a") as f:
+            f.write("http://example.com/dir/c_d.png,c and d\n")
+        backend = CSVDataBackend(accelerator=Mock(), id="foo", csv_file=self.csv_file)
+        for pattern in ["*_*.png", "*/dir/*.png"]:
+            self.assertEqual(
+                backend.list_files(pattern, instance_data_dir=self.temp_dir.name),
+                [("", [], {"http://example.com/dir/c_d.png"})],
+            )
+
+    def test_torch_save_adds_rows_on_save_state(self):
+        tensor_paths = [os.path.join(self.temp_dir.name, f"{i}.pt") for i in range(3)]
+        for tensor_path in tensor_paths:
+            self.backend.torch_save(torch.zeros(2), tensor_path)
+        # Saving the same file twice must not produce a duplicate row.
+        self.backend.torch_save(torch.ones(2), tensor_paths[0])
+        self.assertEqual(len(self.backend.df), 2)
+        self.backend.save_state()
+        self.assertEqual(len(self.backend.df), 5)
+        self.assertTrue(set(tensor_paths).issubset(self.backend.df.index))
+        self.assertTrue(
+            torch.equal(self.backend.torch_load(tensor_paths[0]), torch.ones(2))
+        )
+        # The state is picked up from the parquet file, leaving the csv untouched.
+        self.assertTrue(Path(f"{self.csv_file}.state.parquet").exists())
+        with open(self.csv_file) as f:
+            self.assertEqual(len(f.readlines()), 4)
+        reloaded = CSVDataBackend(accelerator=Mock(), id="foo", csv_file=self.csv_file)
+        self.assertEqual(len(reloaded.df), 5)
+        self.assertEqual(reloaded.get_caption("http://example.com/a.png"), "second a")
+        reloaded.save_state(export_csv=True)
+        with open(self.csv_file) as f:
+            self.assertEqual(len(f.readlines()), 6)
+
+    def test_ignores_dataset_parquet_beside_csv(self):
+        dataset_parquet = self.csv_file.with_suffix(".parquet")
+        dataset_parquet.write_bytes(b"not the backend state")
+        backend = CSVDataBackend(accelerator=Mock(), id="foo", csv_file=self.csv_file)
+        self.assertEqual(len(backend.df), 2)
+        backend.save_state()
+        self.assertEqual(dataset_parquet.read_bytes(), b"not the backend state")
+
+    def test_write_batch(self):
+        filepaths = [
+            os.path.join(self.temp_dir.name, "batch", f"{i}.pt") for i in range(8)
+        ]
+        self.backend.write_batch(filepaths, [torch.full((2,), i) for i in range(8)])
+        for i, filepath in enumerate(filepaths):
+            self.assertTrue(
+                torch.equal(self.backend.torch_load(filepath), torch.full((2,), i))
+            )
+
+    def test_compressed_torch_cache(self):
+        self.backend.compress_cache = True
+        tensor_path = os.path.join(self.temp_dir.name, "compressed.pt")
+        tensor = torch.arange(16, dtype=torch.float32)
+        self.backend.torch_save(tensor, tensor_path)
+        self.assertTrue(torch.equal(self.backend.torch_load(tensor_path), tensor))
+        # Caches written with gzip remain readable.
+        gzip_path = os.path.join(self.temp_dir.name, "gzip.pt")
+        with patch("helpers.data_backend.base.zstandard", None):
+            self.backend.torch_save(tensor, gzip_path)
+        with open(gzip_path, "rb") as f:
+            self.assertEqual(f.read(2), b"\x1f\x8b")
+        self.assertTrue(torch.equal(self.backend.torch_load(gzip_path), tensor))
+
+    def test_read_image_batch_skips_unreadable(self):
+        good_path = os.path.join(self.temp_dir.name, "good.png")
+        Image.new("RGB", (8, 8), color="red").save(good_path)
+        bad_path = os.path.join(self.temp_dir.name, "bad.png")
+        with open(bad_path, "wb") as f:
+            f.write(b"not an image")
+        with self.assertLogs("CSVDataBackend", level="WARNING"):
+            keys, images = self.backend.read_image_batch(
+                [good_path, bad_path, good_path], delete_problematic_images=True
+            )
+        self.assertEqual(keys, [good_path, good_path])
+        self.assertEqual([image.size for image in images], [(8, 8), (8, 8)])
+
+    def test_read_image_batch_accepts_any_iterable(self):
+        image_path = os.path.join(self.temp_dir.name, "image.png")
+        Image.new("RGB", (8, 8)).save(image_path)
+        for filepaths in [(image_path,), iter([image_path])]:
+            keys, images = self.backend.read_image_batch(filepaths)
+            self.assertEqual(keys, [image_path])
+        with self.assertRaises(ValueError):
+            self.backend.read_image_batch(image_path)
+
+
+class QuietHTTPRequestHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class RangeHTTPRequestHandler(QuietHTTPRequestHandler):
+    """A minimal handler that honours single 'bytes=start-end' Range headers."""
+
+    def do_GET(self):
+        range_header = self.headers.get("Range")
+        if range_header is None:
+            return super().do_GET()
+        with open(self.translate_path(self.path), "rb") as f:
+            content = f.read()
+        start, end = (int(x) for x in range_header.split("=")[1].split("-"))
+        end = min(end, len(content) - 1)
+        self.send_response(206)
+        self.send_header("Content-Range", f"bytes {start}-{end}/{len(content)}")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        self.wfile.write(content[start : end + 1])
+
+
+class TestCSVDataBackendHTTP(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.serve_dir = os.path.join(self.temp_dir.name, "serve")
+        self.cache_dir = os.path.join(self.temp_dir.name, "cache")
+        os.makedirs(self.serve_dir)
+        os.makedirs(self.cache_dir)
+        Image.new("RGB", (16, 8), color="blue").save(
+            os.path.join(self.serve_dir, "remote.png")
+        )
+        handler = functools.partial(QuietHTTPRequestHandler, directory=self.serve_dir)
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}/remote.png"
+        self.csv_file = Path(self.temp_dir.name) / "data.csv"
+        with open(self.csv_file, "w") as f:
+            f.write("url,caption\n")
+            f.write(f"{self.url},a remote image\n")
+        self.backend = CSVDataBackend(
+            accelerator=Mock(),
+            id="foo",
+            csv_file=self.csv_file,
+            image_cache_loc=self.cache_dir,
+        )
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.temp_dir.cleanup()
+
+    def test_read_downloads_into_cache(self):
+        with open(os.path.join(self.serve_dir, "remote.png"), "rb") as f:
+            expected = f.read()
+        self.assertEqual(self.backend.read(self.url), expected)
+        self.assertEqual(os.listdir(self.cache_dir), ["remote.png"])
+        # The second read is served from the cache, even with the server gone.
+        self.server.shutdown()
+        self.assertEqual(self.backend.read(self.url), expected)
+        # A fresh backend picks up what's already in the cache directory.
+        backend = CSVDataBackend(
+            accelerator=Mock(),
+            id="foo",
+            csv_file=self.csv_file,
+            image_cache_loc=self.cache_dir,
+        )
+        self.assertEqual(backend._cached_files, {"remote.png"})
+        self.assertEqual(backend.read(self.url), expected)
+
+    def test_concurrent_reads_download_once(self):
+        with patch.object(
+            self.backend, "_fetch_url", wraps=self.backend._fetch_url
+        ) as fetch_url:
+            keys, images = self.backend.read_image_batch([self.url] * 8)
+        self.assertEqual(len(images), 8)
+        self.assertEqual(fetch_url.call_count, 1)
+        self.assertEqual(self.backend._url_locks, {})
+
+    def test_read_waits_for_download_claimed_elsewhere(self):
+        cached_loc = os.path.join(self.cache_dir, "remote.png")
+        # Another process has claimed this download, and finishes it shortly.
+        with open(f"{cached_loc}.tmp", "wb") as f:
+            f.write(b"partial")
+
+        def finish_download():
+            time.sleep(0.3)
+            with open(f"{cached_loc}.tmp", "wb") as f:
+                f.write(b"finished elsewhere")
+            os.replace(f"{cached_loc}.tmp", cached_loc)
+
+        threading.Thread(target=finish_download).start()
+        with patch.object(self.backend.session, "get") as session_get:
+            self.assertEqual(self.backend.read(self.url), b"finished elsewhere")
+        session_get.assert_not_called()
+
+    def test_read_replaces_stalled_download(self):
+        cached_loc = os.path.join(self.cache_dir, "remote.png")
+        with open(f"{cached_loc}.tmp", "wb") as f:
+            f.write(b"partial")
+        stale_time = time.time() - 3600
+        os.utime(f"{cached_loc}.tmp", (stale_time, stale_time))
+        with open(os.path.join(self.serve_dir, "remote.png"), "rb") as f:
+            expected = f.read()
+        with self.assertLogs("CSVDataBackend", level="WARNING"):
+            self.assertEqual(self.backend.read(self.url), expected)
+        self.assertEqual(os.listdir(self.cache_dir), ["remote.png"])
+
+    def test_prefetch_batch(self):
+        missing_url = self.url.replace("remote.png", "missing.png")
+        with self.assertLogs("CSVDataBackend", level="WARNING"):
+            paths = self.backend.prefetch_batch([self.url, missing_url])
+        self.assertEqual(paths, [os.path.join(self.cache_dir, "remote.png"), None])
+        self.assertEqual(os.listdir(self.cache_dir), ["remote.png"])
+
+    def test_read_image_batch_from_urls(self):
+        keys, images = self.backend.read_image_batch([self.url, self.url])
+        self.assertEqual(keys, [self.url, self.url])
+        self.assertEqual([image.size for image in images], [(16, 8), (16, 8)])
+
+    def test_read_downloads_in_ranges(self):
+        handler = functools.partial(RangeHTTPRequestHandler, directory=self.serve_dir)
+        range_server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=range_server.serve_forever, daemon=True).start()
+        self.addCleanup(range_server.server_close)
+        self.addCleanup(range_server.shutdown)
+        large_content = os.urandom(1000)
+        with open(os.path.join(self.serve_dir, "large.bin"), "wb") as f:
+            f.write(large_content)
+        url = f"http://127.0.0.1:{range_server.server_port}/large.bin"
+        with patch("helpers.data_backend.csv.DOWNLOAD_CHUNK_SIZE", 64):
+            self.assertEqual(self.backend.read(url), large_content)
+
+
+if __name__ == "__main__":
+    unittest.main()
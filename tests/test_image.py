@@ -4,6 +4,8 @@ logger = logging.getLogger(__name__)
 logger.setLevel(os.environ.get("SIMPLETUNER_LOG_LEVEL", logging.INFO))
 from unittest.mock import patch
 from unittest.mock import Mock, MagicMock
+import numpy as np
+import torch
 from PIL import Image
 from io import BytesIO
 from helpers.multiaspect.image import MultiaspectImage
@@ -92,6 +94,45 @@ class TestMultiaspectImage(unittest.TestCase):
                         f"Intermediary size is less than reformed size: {intermediary_size} < {reformed_size} (original size: {original_width}x{original_height})",
                     )
 
+    def test_image_to_tensor_matches_transforms(self):
+        rng = np.random.default_rng(0)
+        transforms = MultiaspectImage.get_image_transforms()
+        for shape in [(48, 64, 3), (48, 64)]:
+            image = Image.fromarray(rng.integers(0, 256, shape, dtype=np.uint8))
+            expected = transforms(image)
+            tensor = MultiaspectImage.image_to_tensor(image)
+            self.assertEqual(tensor.shape, expected.shape)
+            self.assertEqual(tensor.dtype, torch.float32)
+            self.assertTrue(torch.allclose(tensor, expected, atol=1e-6))
+            self.assertEqual(
+                MultiaspectImage.image_to_tensor(image, dtype=torch.bfloat16).dtype,
+                torch.bfloat16,
+            )
+
+    def test_calculate_target_sizes_by_pixel_edge_matches_scalar(self):
+        aspect_ratios = [0.33, 0.5, 0.67, 0.75, 1.0, 1.25, 1.33, 1.5, 1.78, 2.0, 8.0]
+        with patch("helpers.training.state_tracker.StateTracker.get_args") as mock_args:
+            for alignment in [8, 64]:
+                mock_args.return_value = Mock(
+                    aspect_bucket_rounding=2, aspect_bucket_alignment=alignment
+                )
+                for edge_length in [256, 512, 1024]:
+                    for original_size in [(4000, 3000), (3000, 4000), (2048, 2048)]:
+                        widths, heights = (
+                            MultiaspectImage.calculate_target_sizes_by_pixel_edge(
+                                np.array(aspect_ratios), edge_length, original_size
+                            )
+                        )
+                        for aspect_ratio, width, height in zip(
+                            aspect_ratios, widths, heights
+                        ):
+                            target_size, _, _ = (
+                                MultiaspectImage.calculate_new_size_by_pixel_edge(
+                                    aspect_ratio, edge_length, original_size
+                                )
+                            )
+                            self.assertEqual((width, height), target_size)
+
     def test_calculate_batch_size_by_pixel_edge(self):
         test_edge_lengths = [1024, 768, 512, 256, 64]
         num_images_per_batch = 100
@@ -0,0 +1,441 @@
+import os
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import torch
+
+from helpers.training.quantisation import (
+    _consolidate_scales,
+    _quantise_on_cpu,
+    _quanto_model,
+    quantoise,
+)
+from helpers.training.quantisation.bulk import bulk_quantise_linears
+from helpers.training.quantisation.cache import (
+    quantisation_cache_path,
+    save_quantised_linears,
+)
+from helpers.training.quantisation.fp8 import (
+    CALIBRATION_HEADROOM,
+    E4M3_MAX,
+    calibrate_activation_scales,
+    enable_delayed_scaling,
+    quantise_linears_to_fp8,
+)
+from helpers.training.quantisation.grouped import (
+    group_dequantise,
+    group_quantise,
+    group_quantise_linears,
+    pack_weight,
+    unpack_weight,
+)
+
+
+def _relative_error(output, expected):
+    return ((output - expected).norm() / expected.norm()).item()
+
+
+def _linear_model(*shapes):
+    torch.manual_seed(0)
+    return torch.nn.Sequential(
+        *[
+            torch.nn.Linear(in_features, out_features)
+            for in_features, out_features in shapes
+        ]
+    )
+
+
+class TestInt8Quantisation(unittest.TestCase):
+    def setUp(self):
+        self.model = _linear_model((64, 128), (128, 64), (64, 64))
+        self.input = torch.randn(4, 8, 64)
+        self.expected = self.model(self.input).detach()
+
+    def test_round_trip(self):
+        self.assertEqual(bulk_quantise_linears(self.model), 3)
+        for module in self.model:
+            self.assertIsInstance(module, torch.nn.Linear)
+            self.assertEqual(module.weight.dtype, torch.int8)
+            self.assertEqual(module.weight_scale.shape, (module.out_features, 1))
+        self.assertLess(_relative_error(self.model(self.input), self.expected), 0.02)
+
+    def test_int_mm_round_trip(self):
+        bulk_quantise_linears(self.model, int_mm=True)
+        self.assertLess(_relative_error(self.model(self.input), self.expected), 0.05)
+
+    def test_input_gradient(self):
+        # LoRA adapters further up the graph need the gradient through the frozen layers.
+        for int_mm in (False, True):
+            model = _linear_model((64, 64))
+            bulk_quantise_linears(model, int_mm=int_mm)
+            input = torch.randn(32, 64, requires_grad=True)
+            model(input).sum().backward()
+            self.assertIsNotNone(input.grad)
+            self.assertFalse(model[0].weight.requires_grad)
+
+    def test_exclude(self):
+        self.assertEqual(bulk_quantise_linears(self.model, exclude={"1"}), 2)
+        self.assertTrue(self.model[1].weight.is_floating_point())
+
+
+class TestGroupedQuantisation(unittest.TestCase):
+    # Gaussian weights can't be reproduced much better than this with 16 and 4 levels.
+    MAX_RELATIVE_ERROR = {4: 0.11, 2: 0.36}
+
+    def test_pack_round_trip(self):
+        for bits in (2, 4):
+            values = torch.randint(0, 2**bits, (8, 64), dtype=torch.uint8)
+            packed = pack_weight(values, bits)
+            self.assertEqual(packed.shape, (8, 64 * bits // 8))
+            self.assertTrue(torch.equal(unpack_weight(packed, bits), values))
+
+    def test_weight_round_trip(self):
+        torch.manual_seed(0)
+        weight = torch.randn(64, 512)
+        for bits, max_error in self.MAX_RELATIVE_ERROR.items():
+            packed, scales = group_quantise(weight, bits, 128)
+            self.assertEqual(scales.shape, (64, 4, 2))
+            dequantised = group_dequantise(packed, scales, bits)
+            self.assertLess(_relative_error(dequantised, weight), max_error, bits)
+
+    def test_constant_groups(self):
+        weight = torch.full((4, 128), 0.25)
+        packed, scales = group_quantise(weight, 2, 128)
+        self.assertTrue(torch.allclose(group_dequantise(packed, scales, 2), weight))
+
+    def test_linears(self):
+        for bits, max_error in self.MAX_RELATIVE_ERROR.items():
+            model = _linear_model((256, 128), (128, 64), (64, 96))
+            input = torch.randn(4, 256)
+            expected = model(input).detach()
+            self.assertEqual(group_quantise_linears(model, bits), 3)
+            for module in model:
+                self.assertEqual(module.weight.dtype, torch.uint8)
+            # Errors compound through the layers.
+            self.assertLess(_relative_error(model(input), expected), 2 * max_error)
+
+    def test_input_gradient(self):
+        model = _linear_model((128, 64))
+        group_quantise_linears(model, 4)
+        input = torch.randn(2, 128, requires_grad=True)
+        model(input).sum().backward()
+        self.assertIsNotNone(input.grad)
+
+    def test_invalid_bits(self):
+        with self.assertRaises(ValueError):
+            group_quantise_linears(_linear_model((128, 64)), 3)
+
+
+class TestFp8Quantisation(unittest.TestCase):
+    def setUp(self):
+        self.model = _linear_model((64, 128), (128, 64))
+        self.input = torch.randn(4, 8, 64)
+
+    def test_round_trip(self):
+        expected = self.model(self.input).detach()
+        self.assertEqual(quantise_linears_to_fp8(self.model), 2)
+        self.assertEqual(self.model[0].weight.dtype, torch.float8_e4m3fn)
+        self.assertLess(_relative_error(self.model(self.input), expected), 0.1)
+
+    def test_calibration_headroom(self):
+        scales = calibrate_activation_scales(self.model, [self.input])
+        expected = self.input.abs().amax() * CALIBRATION_HEADROOM / E4M3_MAX
+        self.assertTrue(torch.allclose(scales["0"], expected))
+
+    def test_inputs_within_calibration_headroom(self):
+        scales = calibrate_activation_scales(self.model, [self.input])
+        # Larger than anything seen during calibration, but within its headroom.
+        large_input = self.input * 1.5
+        expected = self.model(large_input).detach()
+        quantise_linears_to_fp8(self.model, activation_scales=scales)
+        self.assertIn("input_scale", self.model[0]._buffers)
+        with patch("torch.linalg.vector_norm") as vector_norm:
+            output = self.model(large_input)
+        # Cast with the calibrated scale, without reducing over the input.
+        vector_norm.assert_not_called()
+        self.assertLess(_relative_error(output, expected), 0.1)
+
+    def test_delayed_scaling_uses_running_scale(self):
+        quantise_linears_to_fp8(self.model)
+        self.assertEqual(enable_delayed_scaling(self.model, 2), 2)
+        for _ in range(2):
+            self.model(self.input)
+        input_scale = self.model[0].input_scale.clone()
+        self.assertEqual(self.model[0].input_scale_warmup, 0)
+        with patch("torch.linalg.vector_norm") as vector_norm:
+            self.model(self.input * 1.5)
+        # Cast with the running scale as it is, without reducing over the input.
+        vector_norm.assert_not_called()
+        self.assertTrue(torch.equal(self.model[0].input_scale, input_scale))
+
+
+class TestPrecisionDispatch(unittest.TestCase):
+    def _model(self):
+        # Large enough to pass MIN_QUANTISATION_PARAMETERS.
+        return _linear_model((1024, 1024), (1024, 512))
+
+    def test_precisions(self):
+        weight_dtypes = {
+            "int8-quanto": torch.int8,
+            "int4-quanto": torch.uint8,
+            "int2-quanto": torch.uint8,
+            "bf16": torch.bfloat16,
+        }
+        for precision, dtype in weight_dtypes.items():
+            model = self._model()
+            _quanto_model(model, precision)
+            self.assertEqual(model[0].weight.dtype, dtype, precision)
+
+    def test_int8_is_weight_only_by_default(self):
+        model = self._model()
+        _quanto_model(model, "int8-quanto")
+        self.assertFalse(model[0].weight_int_mm)
+
+    def test_int8_activations_are_opt_in(self):
+        # Not gated on the batch size: the row count is batch x tokens, checked per call.
+        model = self._model()
+        _quanto_model(model, "int8-quanto", int8_activations=True)
+        self.assertTrue(model[0].weight_int_mm)
+
+    def test_no_change(self):
+        model = self._model()
+        _quanto_model(model, "no_change")
+        self.assertEqual(model[0].weight.dtype, torch.float32)
+
+    def test_small_models_are_skipped(self):
+        model = _linear_model((64, 64))
+        _quanto_model(model, "int8-quanto")
+        self.assertEqual(model[0].weight.dtype, torch.float32)
+
+    def test_invalid_precision(self):
+        with self.assertRaises(ValueError):
+            _quanto_model(self._model(), "int3-quanto")
+
+    def test_skipped_models_are_not_submitted(self):
+        quantised = _CheckpointModel()
+        small = _linear_model((64, 64))
+        unchanged = _CheckpointModel(name_or_path="test/unchanged")
+        args = _quantoise_args("int8-quanto", text_encoder_3_precision="no_change")
+        with patch(
+            "helpers.training.quantisation._quantise_on_cpu",
+            wraps=_quantise_on_cpu,
+        ) as quantise_on_cpu, patch.object(small, "to") as small_to, patch.object(
+            unchanged, "to"
+        ) as unchanged_to:
+            quantoise(None, None, quantised, small, unchanged, args)
+        self.assertEqual(
+            [call.args[0] for call in quantise_on_cpu.call_args_list], [quantised]
+        )
+        small_to.assert_not_called()
+        unchanged_to.assert_not_called()
+        self.assertEqual(quantised[0].weight.dtype, torch.int8)
+
+
+class _CheckpointModel(torch.nn.Sequential):
+    """
+    A model large enough to be quantised, which says which checkpoint it came from.
+    """
+
+    def __init__(self, seed=0, name_or_path="test/checkpoint"):
+        torch.manual_seed(seed)
+        super().__init__(torch.nn.Linear(1024, 1024), torch.nn.Linear(1024, 512))
+        self.config = SimpleNamespace(_name_or_path=name_or_path)
+
+
+class TestQuantisationCache(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        patcher = patch(
+            "helpers.training.quantisation.cache.QUANTISATION_CACHE_DIR",
+            self.temp_dir.name,
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.temp_dir.cleanup)
+
+    def _cached_files(self):
+        return sorted(os.listdir(self.temp_dir.name))
+
+    def test_hit(self):
+        for precision in ("int8-quanto", "int4-quanto"):
+            first, second = _CheckpointModel(), _CheckpointModel()
+            _quanto_model(first, precision)
+            cached_files = self._cached_files()
+            with patch(
+                "helpers.training.quantisation.bulk_quantise_linears"
+            ) as bulk, patch(
+                "helpers.training.quantisation.group_quantise_linears"
+            ) as grouped:
+                _quanto_model(second, precision)
+            bulk.assert_not_called()
+            grouped.assert_not_called()
+            self.assertEqual(self._cached_files(), cached_files)
+            for module, cached in zip(first, second):
+                self.assertTrue(torch.equal(module.weight, cached.weight))
+                self.assertTrue(torch.equal(module.weight_scale, cached.weight_scale))
+                self.assertTrue(
+                    torch.equal(module(torch.ones(1024)), cached(torch.ones(1024)))
+                )
+
+    def test_miss_on_changed_weights(self):
+        first = _CheckpointModel(seed=0)
+        second = _CheckpointModel(seed=1)
+        with torch.no_grad():
+            second[0].weight.mul_(2)
+        self.assertNotEqual(
+            quantisation_cache_path(first, "int8-quanto"),
+            quantisation_cache_path(second, "int8-quanto"),
+        )
+        expected_scale = second[0].weight.abs().amax(dim=1, keepdim=True) / 127
+        _quanto_model(first, "int8-quanto")
+        _quanto_model(second, "int8-quanto")
+        self.assertEqual(len(self._cached_files()), 2)
+        self.assertTrue(torch.allclose(second[0].weight_scale, expected_scale))
+
+    def test_miss_on_precision_and_exclusions(self):
+        model = _CheckpointModel()
+        paths = {
+            quantisation_cache_path(model, "int8-quanto"),
+            quantisation_cache_path(model, "int4-quanto"),
+            quantisation_cache_path(model, "int8-quanto", exclude={"0"}),
+        }
+        self.assertEqual(len(paths), 3)
+
+    def test_disabled(self):
+        _quanto_model(_CheckpointModel(), "int8-quanto", use_cache=False)
+        self.assertEqual(self._cached_files(), [])
+
+    def test_write_failures_are_not_fatal(self):
+        model = _CheckpointModel()
+        with patch(
+            "helpers.training.quantisation.cache.save_file",
+            side_effect=OSError("No space left on device"),
+        ):
+            _quanto_model(model, "int8-quanto")
+        self.assertEqual(model[0].weight.dtype, torch.int8)
+        self.assertEqual(self._cached_files(), [])
+
+    def test_concurrent_writes(self):
+        model = _CheckpointModel()
+        _quanto_model(model, "int8-quanto", use_cache=False)
+        path = os.path.join(self.temp_dir.name, "model.safetensors")
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            for future in [
+                executor.submit(save_quantised_linears, model, path) for _ in range(4)
+            ]:
+                future.result()
+        self.assertEqual(self._cached_files(), ["model.safetensors"])
+
+    def test_models_without_a_checkpoint_are_not_cached(self):
+        model = _CheckpointModel()
+        del model.config
+        _quanto_model(model, "int8-quanto")
+        self.assertEqual(model[0].weight.dtype, torch.int8)
+        self.assertEqual(self._cached_files(), [])
+
+
+def _quantoise_args(precision, **overrides):
+    args = dict(
+        base_model_precision=precision,
+        text_encoder_1_precision=None,
+        text_encoder_2_precision=None,
+        text_encoder_3_precision=None,
+        fp8_activation_warmup_steps=0,
+        disable_quantisation_cache=True,
+        int8_activation_quantisation=False,
+    )
+    return SimpleNamespace(**{**args, **overrides})
+
+
+class TestDuplicateSharing(unittest.TestCase):
+    def test_same_checkpoint_is_shared(self):
+        for precision in ("int8-quanto", "int4-quanto"):
+            first, second = _CheckpointModel(), _CheckpointModel()
+            quantoise(None, None, first, second, None, _quantoise_args(precision))
+            input = torch.randn(2, 1024)
+            for module, duplicate in zip(first, second):
+                self.assertIs(duplicate.weight, module.weight)
+                self.assertIs(duplicate.weight_scale, module.weight_scale)
+            self.assertTrue(torch.equal(first(input), second(input)))
+
+    def test_different_checkpoints_are_not_shared(self):
+        first = _CheckpointModel(seed=0, name_or_path="test/first")
+        second = _CheckpointModel(seed=1, name_or_path="test/second")
+        expected = second(torch.ones(1024)).detach()
+        quantoise(None, None, first, second, None, _quantoise_args("int8-quanto"))
+        self.assertIsNot(second[0].weight, first[0].weight)
+        self.assertEqual(second[0].weight.dtype, torch.int8)
+        self.assertLess(_relative_error(second(torch.ones(1024)), expected), 0.02)
+
+    def test_same_checkpoint_with_different_weights_is_not_shared(self):
+        # Like SD3's CLIP-L and CLIP-G, which both report the pipeline's path.
+        wider = _CheckpointModel()
+        wider[1] = torch.nn.Linear(1024, 768)
+        for first, second in (
+            (_CheckpointModel(seed=0), _CheckpointModel(seed=1)),
+            (_CheckpointModel(), wider),
+        ):
+            input = torch.randn(2, 1024)
+            expected = second(input).detach()
+            quantoise(None, None, first, second, None, _quantoise_args("int8-quanto"))
+            self.assertIsNot(second[1].weight, first[1].weight)
+            self.assertEqual(second[1].weight.dtype, torch.int8)
+            self.assertLess(_relative_error(second(input), expected), 0.05)
+
+    def test_different_precisions_are_not_shared(self):
+        first, second = _CheckpointModel(), _CheckpointModel()
+        args = _quantoise_args("int8-quanto", text_encoder_2_precision="int4-quanto")
+        quantoise(None, None, first, second, None, args)
+        self.assertEqual(first[0].weight.dtype, torch.int8)
+        self.assertEqual(second[0].weight_bits, 4)
+
+
+class TestScaleConsolidation(unittest.TestCase):
+    def setUp(self):
+        self.model = _linear_model((64, 128), (128, 64), (64, 64))
+        bulk_quantise_linears(self.model)
+
+    def assertConsolidated(self, model):
+        buffers = [
+            buffer
+            for name, buffer in model.named_buffers()
+            if name.startswith("_quantised_scales_")
+        ]
+        self.assertEqual(len(buffers), 1)
+        storage = buffers[0].untyped_storage().data_ptr()
+        for module in model:
+            self.assertEqual(module.weight_scale.untyped_storage().data_ptr(), storage)
+        return buffers[0]
+
+    def test_scales_are_views(self):
+        input = torch.randn(2, 64)
+        expected = self.model(input)
+        self.assertEqual(_consolidate_scales(self.model), 3)
+        scales = self.assertConsolidated(self.model)
+        self.assertEqual(scales.numel(), 128 + 64 + 64)
+        self.assertTrue(torch.equal(self.model(input), expected))
+
+    def test_scales_stay_consolidated_when_moved(self):
+        _consolidate_scales(self.model)
+        input = torch.randn(2, 64)
+        expected = self.model(input)
+        # Module._apply copies each buffer on its own, as .to(device) does.
+        self.model._apply(lambda tensor: tensor.clone())
+        self.assertConsolidated(self.model)
+        self.model.to(torch.float64)
+        scales = self.assertConsolidated(self.model)
+        self.assertEqual(scales.dtype, torch.float64)
+        self.assertTrue(torch.allclose(self.model(input.double()), expected.double()))
+
+    def test_moving_a_parent_reconsolidates(self):
+        _consolidate_scales(self.model)
+        parent = torch.nn.Sequential(self.model)
+        parent._apply(lambda tensor: tensor.clone())
+        self.assertConsolidated(self.model)
+
+
+if __name__ == "__main__":
+    unittest.main()
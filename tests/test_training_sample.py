@@ -1,7 +1,11 @@
 import unittest
 from PIL import Image
 import numpy as np
-from helpers.image_manipulation.training_sample import TrainingSample
+import torch
+from helpers.image_manipulation.training_sample import (
+    PreparedSample,
+    TrainingSample,
+)
 from helpers.training.state_tracker import StateTracker
 from unittest.mock import MagicMock
 
@@ -79,6 +83,134 @@ class TestTrainingSample(unittest.TestCase):
             isinstance(prepared_sample.aspect_ratio, float)
         )  # Placeholder check
 
+    def test_correct_image_skips_noop_conversions(self):
+        """An RGB image without an EXIF orientation should not be copied."""
+        sample = TrainingSample(self.image, self.data_backend_id, self.image_metadata)
+        self.assertIs(sample.get_image(), self.image)
+
+    def test_correct_image_converts_to_rgb(self):
+        """Images with an alpha channel are converted to RGB."""
+        image = Image.new("RGBA", (1024, 768), "white")
+        sample = TrainingSample(image, self.data_backend_id, self.image_metadata)
+        self.assertEqual(sample.get_image().mode, "RGB")
+
+    def test_correct_image_applies_exif_orientation(self):
+        """An EXIF orientation tag is applied to the image."""
+        image = Image.new("RGB", (1024, 768), "white")
+        image.getexif()[0x0112] = 6  # Rotated 90 degrees clockwise.
+        sample = TrainingSample(image, self.data_backend_id, self.image_metadata)
+        self.assertEqual(sample.get_image().size, (768, 1024))
+
+    def test_correct_image_is_deferred(self):
+        """Pixels are only corrected once they are needed."""
+        image = Image.new("RGBA", (1024, 768), "white")
+        image.getexif()[0x0112] = 6  # Rotated 90 degrees clockwise.
+        sample = TrainingSample(image, self.data_backend_id, {})
+        self.assertIs(sample.image, image)
+        # The rotated size is still known up front, from the EXIF header.
+        self.assertEqual(sample.original_size, (768, 1024))
+        sample.prepare()
+        self.assertEqual(sample.image.mode, "RGB")
+
+    def _random_aspect_config(self, buckets):
+        return {
+            "crop": True,
+            "crop_style": "center",
+            "crop_aspect": "random",
+            "crop_aspect_buckets": buckets,
+            "resolution": 512,
+            "resolution_type": "pixel",
+        }
+
+    def test_weighted_random_aspect_selection(self):
+        """Weighted aspect buckets are sampled according to their weights."""
+        StateTracker.get_data_backend_config = MagicMock(
+            return_value=self._random_aspect_config(
+                [{"aspect": 0.75, "weight": 0.0}, {"aspect": 1.5, "weight": 1.0}]
+            )
+        )
+        sample = TrainingSample(self.image, self.data_backend_id, {})
+        for _ in range(10):
+            self.assertEqual(sample._select_random_aspect(), 1.5)
+
+    def test_random_aspect_from_float_buckets(self):
+        """Plain float buckets are sampled from those that fit the image."""
+        StateTracker.get_data_backend_config = MagicMock(
+            return_value=self._random_aspect_config([0.75, 1.5, 3.0])
+        )
+        sample = TrainingSample(self.image, self.data_backend_id, {})
+        self.assertEqual(sample._trim_aspect_bucket_list(), [0.75, 1.5])
+        self.assertIn(sample._select_random_aspect(), [0.75, 1.5])
+
+    def test_random_aspect_from_integer_buckets(self):
+        """Integer buckets are accepted alongside floats."""
+        StateTracker.get_data_backend_config = MagicMock(
+            return_value=self._random_aspect_config([1, 1.5])
+        )
+        sample = TrainingSample(self.image, self.data_backend_id, {})
+        self.assertEqual(sample._trim_aspect_bucket_list(), [1.0, 1.5])
+
+    def test_random_aspect_rejects_mixed_buckets(self):
+        """Aspect buckets can't mix floats and dictionaries."""
+        StateTracker.get_data_backend_config = MagicMock(
+            return_value=self._random_aspect_config(
+                [0.75, {"aspect": 1.5, "weight": 1.0}]
+            )
+        )
+        with self.assertRaises(ValueError):
+            TrainingSample(self.image, self.data_backend_id, {})
+
+    def test_weighted_random_aspect_invalid_weights(self):
+        """Aspect bucket weights must add up to 1."""
+        StateTracker.get_data_backend_config = MagicMock(
+            return_value=self._random_aspect_config(
+                [{"aspect": 0.75, "weight": 0.5}, {"aspect": 1.5, "weight": 0.6}]
+            )
+        )
+        with self.assertRaises(ValueError):
+            TrainingSample(self.image, self.data_backend_id, {})
+
+    def test_resize_uses_configured_resampler(self):
+        """resize_resample and resize_reducing_gap are passed through to Image.resize."""
+        StateTracker.get_data_backend_config = MagicMock(
+            return_value={
+                "crop": False,
+                "resolution": 512,
+                "resolution_type": "pixel",
+                "resize_resample": "bicubic",
+                "resize_reducing_gap": 3.0,
+            }
+        )
+        image = Image.effect_noise((2048, 2048), 64).convert("RGB")
+        sample = TrainingSample(image, self.data_backend_id, {})
+        sample.resize((512, 512))
+        expected = image.resize((512, 512), Image.Resampling.BICUBIC, reducing_gap=3.0)
+        self.assertEqual(sample.image.tobytes(), expected.tobytes())
+
+    def test_prepared_sample_aspect_ratio(self):
+        """PreparedSample rounds the aspect ratio of PIL images, and keeps the given one for tensors."""
+        StateTracker.get_args.return_value.aspect_bucket_rounding = 2
+        sample = PreparedSample(
+            image=Image.new("RGB", (1920, 1080)),
+            image_metadata={},
+            original_size=(1920, 1080),
+            intermediary_size=(1920, 1080),
+            target_size=(1920, 1080),
+            aspect_ratio=None,
+            crop_coordinates=(0, 0),
+        )
+        self.assertEqual(sample.aspect_ratio, 1.78)
+        sample = PreparedSample(
+            image=torch.zeros(3, 1080, 1920),
+            image_metadata={},
+            original_size=(1920, 1080),
+            intermediary_size=(1920, 1080),
+            target_size=(1920, 1080),
+            aspect_ratio=1.5,
+            crop_coordinates=(0, 0),
+        )
+        self.assertEqual(sample.aspect_ratio, 1.5)
+
 
 # Helper mock classes and functions
 class MockCropper:
@@ -1,4 +1,4 @@
-from PIL import Image
+from PIL import Image, ImageStat
 import os, logging
 import csv
 import shutil
@@ -10,17 +10,8 @@ from concurrent.futures import ThreadPoolExecutor
 
 
 def calculate_luminance(img: Image):
-    pixels = list(img.getdata())
-
-    luminance_values = []
-    for pixel in pixels:
-        r, g, b = pixel[:3]  # Assuming the image is RGB or RGBA
-        luminance = 0.299 * r + 0.587 * g + 0.114 * b
-        luminance_values.append(luminance)
-
-    # Return average luminance for the entire image
-    avg_luminance = sum(luminance_values) / len(luminance_values)
-    return avg_luminance
+    # ITU-R BT.601 luma via PIL's "L" conversion, averaged in C by ImageStat.
+    return ImageStat.Stat(img.convert("L")).mean[0]
 
 
 def get_camera_model(img):
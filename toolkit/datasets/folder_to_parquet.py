@@ -12,7 +12,7 @@ image_data
 """
 
 import os, argparse
-from PIL import Image
+from PIL import Image, ImageStat
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
@@ -29,9 +29,7 @@ def get_image_hash(image):
 
 def get_image_luminance(image):
     """Calculate the luminance of an image."""
-    image = image.convert("L")
-    pixels = list(image.getdata())
-    return sum(pixels) / len(pixels)
+    return ImageStat.Stat(image.convert("L")).mean[0]
 
 
 def get_size(image):
@@ -34,6 +34,7 @@ from helpers.training.state_tracker import StateTracker
 from helpers.data_backend.factory import BatchFetcher
 from helpers.training.deepspeed import deepspeed_zero_init_disabled_context_manager
 from helpers.training.wrappers import unwrap_model
+from helpers.training import lora_target_modules
 from helpers.data_backend.factory import configure_multi_databackend
 from helpers.data_backend.factory import random_dataloader_iterator
 from helpers.training.custom_schedule import (
@@ -682,15 +683,12 @@ def main():
         and args.base_model_precision != "no_change"
     ):
         lock_weight_dtype = True
-        is_quantised = True
-        if "quanto" in args.base_model_precision:
-            try:
-                from optimum.quanto import QTensor
-            except ImportError as e:
-                raise ImportError(
-                    f"To use Quanto, please install the optimum library: `pip install optimum-quanto`: {e}"
-                )
-            from helpers.training.quantisation import quantoise
+        # bf16 only casts the weights, which the bf16 optimisers can still train.
+        is_quantised = args.base_model_precision != "bf16"
+        if "quanto" in args.base_model_precision or args.base_model_precision == "bf16":
+            # Only fp8 on GPUs without native fp8 support goes through Quanto, which raises
+            # there if it isn't installed. QTensor is None without Quanto.
+            from helpers.training.quantisation import QTensor, quantoise
 
             quantoise(
                 unet, transformer, text_encoder_1, text_encoder_2, text_encoder_3, args
@@ -764,18 +762,17 @@ def main():
                 lora_alpha=args.lora_alpha,
                 lora_dropout=args.lora_dropout,
                 init_lora_weights=lora_weight_init_type,
-                target_modules=["to_k", "to_q", "to_v", "to_out.0"],
+                target_modules=lora_target_modules,
                 use_dora=args.use_dora,
             )
             logger.info("Adding LoRA adapter to the unet model..")
             unet.add_adapter(unet_lora_config)
         if transformer is not None:
-            target_modules = ["to_k", "to_q", "to_v", "to_out.0"]
             transformer_lora_config = LoraConfig(
                 r=args.lora_rank,
                 lora_alpha=args.lora_alpha,
                 init_lora_weights=lora_weight_init_type,
-                target_modules=target_modules,
+                target_modules=lora_target_modules,
                 use_dora=args.use_dora,
             )
             transformer.add_adapter(transformer_lora_config)
@@ -2116,7 +2113,7 @@ def main():
                     model_pred = torch.randn_like(noisy_latents)
 
                 # if we're quantising with quanto, we need to dequantise the result
-                if "quanto" in args.base_model_precision:
+                if "quanto" in args.base_model_precision and QTensor is not None:
                     if hasattr(model_pred, "dequantize") and isinstance(
                         model_pred, QTensor
                     ):